@@ -6,6 +6,9 @@ import json
 import os
 from langchain_openai import ChatOpenAI
 from customer_service_ai import CustomerServiceAI
+from kb_watcher import KnowledgeBaseWatcher
+from assistant_registry import get_default_registry, qa_content_key
+from request_profiler import recent_profiles
 
 # 頁面設定
 st.set_page_config(
@@ -30,6 +33,9 @@ def clear_debug_info():
     st.session_state.debug_info = []
     st.session_state.clear_debug = True
 
+# 效能分析只在調試模式中提供
+profile_mode = False
+
 # 創建一個調試信息顯示容器
 if debug_mode:
     # 添加清除調試信息的按鈕
@@ -53,6 +59,27 @@ if debug_mode:
         else:
             st.info("尚無調試信息。請提出問題以生成調試信息。")
 
+    # 效能分析：對之後的每個回答取樣呼叫堆疊，並提供火焰圖檔案下載
+    profile_mode = st.sidebar.checkbox("分析回答效能")
+    with st.sidebar.expander("效能分析", expanded=profile_mode):
+        profiles = recent_profiles()
+        if profiles:
+            labels = [f"{p['created_at']} {p['name']}（{p['duration']} 秒）" for p in profiles]
+            selected = st.selectbox("效能分析記錄", range(len(profiles)), format_func=lambda i: labels[i])
+            record = profiles[selected]
+            st.text(record["summary"])
+            if record["folded"] and os.path.exists(record["folded"]):
+                with open(record["folded"], "r", encoding="utf-8") as f:
+                    st.download_button(
+                        "下載火焰圖資料（collapsed stack）",
+                        f.read(),
+                        file_name=os.path.basename(record["folded"]),
+                        key="download_profile",
+                    )
+                st.caption("可用 flamegraph.pl 或 speedscope.app 開啟")
+        else:
+            st.info("尚無效能分析記錄。勾選「分析回答效能」後提出問題。")
+
 # 自定義 CSS
 st.markdown("""
 <style>
@@ -126,20 +153,44 @@ st.markdown("""
 def initialize_llm():
     return ChatOpenAI(model="gpt-4o")
 
-# 初始化客服助手
-@st.cache_resource
-def initialize_customer_service():
-    llm = initialize_llm()
-
-    # 預設 Q&A 資料
-    default_qa = []
+# 建立客服助手並建立向量索引
+def build_customer_service(qa_data):
+    cs_assistant = CustomerServiceAI(initialize_llm())
+    cs_assistant.load_qa_data(qa_data)
+    return cs_assistant
 
-    # 檢查是否有 Q&A 檔案
-    qa_file = "customer_service_qa.json"
-    if os.path.exists(qa_file):
-        return CustomerServiceAI(llm, qa_file=qa_file)
-    else:
-        return CustomerServiceAI(llm, qa_data=default_qa)
+# 初始化知識庫監看器（檔案變更時在背景重建並替換，所有 session 共用）
+@st.cache_resource
+def initialize_knowledge_base():
+    return KnowledgeBaseWatcher("customer_service_qa.json", build_customer_service).start()
+
+# 使用上傳的 Q&A 資料（相同內容的知識庫在所有 session 間只建立一次索引）
+def use_uploaded_qa_data(qa_data):
+    key = qa_content_key(qa_data)
+    lease = st.session_state.get("cs_assistant_lease")
+    if lease is not None and lease.key == key:
+        return False
+
+    new_lease = get_default_registry().acquire(key, lambda: build_customer_service(qa_data))
+    release_uploaded_qa_data()
+    st.session_state.cs_assistant_lease = new_lease
+    st.session_state.cs_assistant = new_lease.assistant
+    return True
+
+# 歸還目前 session 借用的客服助手
+def release_uploaded_qa_data():
+    lease = st.session_state.pop("cs_assistant_lease", None)
+    if lease is not None:
+        lease.release()
+
+# 取得客服助手
+def get_cs_assistant():
+    # 使用者上傳的知識庫優先，否則使用預設知識庫目前的版本
+    if "cs_assistant" in st.session_state:
+        return st.session_state.cs_assistant
+    if "customer_service" in st.session_state:
+        return st.session_state.customer_service
+    return initialize_knowledge_base().current().assistant
 
 # 初始化聊天歷史 - 改為存儲問答對
 if "cs_qa_pairs" not in st.session_state:
@@ -180,12 +231,8 @@ with tab2:
 
         for q in common_questions:
             if st.button(q, key=f"cs_{q}"):
-                # 初始化客服助手（如果尚未初始化）
-                if "cs_assistant" not in st.session_state:
-                    if "customer_service" in st.session_state:
-                        st.session_state.cs_assistant = st.session_state.customer_service
-                    else:
-                        st.session_state.cs_assistant = initialize_customer_service()
+                # 取得客服助手（整個問題使用同一個知識庫版本）
+                cs_assistant = get_cs_assistant()
 
                 # 處理問題並獲取回應
                 with st.spinner("客服助手正在思考..."):
@@ -195,7 +242,7 @@ with tab2:
                                 st.session_state.debug_info.append(message)
 
                         # 獲取回應
-                        assistant_response = st.session_state.cs_assistant.answer_question(q, debug_callback=save_debug_info)
+                        assistant_response = cs_assistant.answer_question(q, debug_callback=save_debug_info, profile=profile_mode)
 
                         # 添加問答對到歷史的開頭
                         st.session_state.cs_qa_pairs.insert(0, {"question": q, "answer": assistant_response})
@@ -224,10 +271,10 @@ with tab2:
 
             if uploaded_file is not None:
                 try:
-                    qa_data = json.load(uploaded_file)
-                    # 重新初始化客服 AI
-                    llm = initialize_llm()
-                    st.session_state.cs_assistant = CustomerServiceAI(llm, qa_data=qa_data)
+                    qa_data = json.loads(uploaded_file.getvalue())
+                    # 切換到此內容的客服 AI（重新執行頁面時內容未變則不重建）
+                    with st.spinner("正在建立向量索引..."):
+                        use_uploaded_qa_data(qa_data)
                     st.success("成功載入 JSON Q&A 資料！")
                 except Exception as e:
                     st.error(f"載入 JSON Q&A 資料時出錯: {str(e)}")
@@ -275,6 +322,7 @@ with tab2:
                     if cs_assistant.processing_status["status"] == "error":
                         st.error(f"處理 Word 檔案時出錯: {cs_assistant.processing_status['message']}")
                     else:
+                        release_uploaded_qa_data()
                         st.session_state.cs_assistant = cs_assistant
                         st.success(f"成功載入 Word Q&A 資料！已解析 {len(qa_data)} 個問答對")
 
@@ -328,12 +376,8 @@ with tab2:
     if cs_input_text:
         # 顯示助手正在思考的提示
         with st.status("客服助手正在思考..."):
-            # 初始化客服助手
-            if "cs_assistant" not in st.session_state:
-                if "customer_service" in st.session_state:
-                    st.session_state.cs_assistant = st.session_state.customer_service
-                else:
-                    st.session_state.cs_assistant = initialize_customer_service()
+            # 取得客服助手（整個問題使用同一個知識庫版本）
+            cs_assistant = get_cs_assistant()
 
             # 處理問題
             try:
@@ -344,7 +388,7 @@ with tab2:
                         print(f"調試信息: {message}")
 
                 # 獲取回應
-                assistant_response = st.session_state.cs_assistant.answer_question(cs_input_text, debug_callback=save_debug_info)
+                assistant_response = cs_assistant.answer_question(cs_input_text, debug_callback=save_debug_info, profile=profile_mode)
 
                 # 添加問答對到歷史的開頭
                 st.session_state.cs_qa_pairs.insert(0, {"question": cs_input_text, "answer": assistant_response})
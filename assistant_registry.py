@@ -0,0 +1,168 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import weakref
+
+
+def qa_content_key(qa_data):
+    """以 Q&A 內容計算雜湊，格式（縮排、鍵順序）不同但內容相同時得到相同的鍵"""
+    canonical = json.dumps(qa_data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def estimate_assistant_size(assistant):
+    """粗略估計客服助手佔用的記憶體（位元組）"""
+    size = sum(len(qa.get("question", "")) + len(qa.get("answer", "")) for qa in assistant.qa_data) * 4
+
+    vector_store = getattr(assistant, "vector_store", None)
+    index = getattr(vector_store, "index", None)
+    if index is not None:
+        # 向量本身（float32）加上文檔存儲中的文字
+        size += index.ntotal * index.d * 4 + size * 2
+    return size
+
+
+class AssistantLease:
+    """
+    借用登錄表中的客服助手
+
+    使用完畢呼叫 release()；若持有者（例如 Streamlit session）被回收而未呼叫，
+    也會自動歸還。
+    """
+
+    def __init__(self, registry, key, assistant):
+        self.key = key
+        self.assistant = assistant
+        self._finalizer = weakref.finalize(self, registry.release, key)
+
+    def release(self):
+        self._finalizer()
+
+
+class _RegistryEntry:
+    def __init__(self):
+        self.assistant = None
+        self.size = 0
+        self.ref_count = 0
+        self.ready = threading.Event()
+        self.error = None
+
+
+class AssistantRegistry:
+    """
+    行程層級的客服助手登錄表
+
+    相同內容的知識庫只建立一次索引，並以唯讀方式在各 session 間共用。
+    以引用計數追蹤使用中的助手，總記憶體超過上限時依 LRU 淘汰未被使用的助手。
+
+    參數:
+    max_memory_bytes (int): 記憶體上限（位元組）
+    """
+
+    def __init__(self, max_memory_bytes=512 * 1024 * 1024):
+        self.max_memory_bytes = max_memory_bytes
+        self._entries = OrderedDict()
+        # 借用憑證可能在垃圾回收時歸還，使用可重入鎖避免死結
+        self._lock = threading.RLock()
+        self.stats = {"hits": 0, "builds": 0, "evictions": 0}
+
+    def acquire(self, key, build_assistant):
+        """
+        取得指定內容的客服助手，不存在時建立
+
+        參數:
+        key (str): 知識庫內容的雜湊（見 qa_content_key）
+        build_assistant (callable): 無參數，返回已建立索引的客服助手
+
+        返回:
+        AssistantLease: 借用憑證，透過 .assistant 取得助手
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            is_builder = entry is None
+            if is_builder:
+                entry = _RegistryEntry()
+                self._entries[key] = entry
+            else:
+                self.stats["hits"] += 1
+            entry.ref_count += 1
+            self._entries.move_to_end(key)
+
+        if is_builder:
+            # 在鎖外建立索引，其他 session 上傳相同內容時等待這次建立完成
+            try:
+                assistant = build_assistant()
+                processing_status = getattr(assistant, "processing_status", {})
+                if processing_status.get("status") == "error":
+                    raise RuntimeError(processing_status.get("message"))
+                entry.assistant = assistant
+                entry.size = estimate_assistant_size(assistant)
+                with self._lock:
+                    self.stats["builds"] += 1
+                    self._evict()
+            except Exception as e:
+                entry.error = e
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                raise
+            finally:
+                entry.ready.set()
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                raise entry.error
+
+        return AssistantLease(self, key, entry.assistant)
+
+    def release(self, key):
+        """歸還借用的助手"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.ref_count > 0:
+                entry.ref_count -= 1
+            self._evict()
+
+    def _evict(self):
+        total = sum(entry.size for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_memory_bytes:
+                break
+            entry = self._entries[key]
+            if entry.ref_count == 0 and entry.ready.is_set():
+                total -= entry.size
+                del self._entries[key]
+                self.stats["evictions"] += 1
+                print(f"已從登錄表移除未使用的客服助手: {key[:12]}")
+
+    def describe(self):
+        """返回登錄表目前的狀態"""
+        with self._lock:
+            return {
+                "entries": [
+                    {"key": key[:12], "ref_count": entry.ref_count, "size": entry.size}
+                    for key, entry in self._entries.items()
+                ],
+                "total_size": sum(entry.size for entry in self._entries.values()),
+                **self.stats,
+            }
+
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def get_default_registry():
+    """
+    取得行程共用的登錄表
+
+    記憶體上限可透過環境變數 ASSISTANT_REGISTRY_MAX_MB 設定（預設 512）
+    """
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            max_mb = float(os.environ.get("ASSISTANT_REGISTRY_MAX_MB", "512"))
+            _default_registry = AssistantRegistry(max_memory_bytes=int(max_mb * 1024 * 1024))
+        return _default_registry
@@ -0,0 +1,132 @@
+from functools import lru_cache
+import re
+
+# 截斷答案時優先在這些位置斷開
+_BOUNDARY_PATTERN = re.compile(r"(?<=[\n。！？!?；;])")
+_TRUNCATION_MARK = "……"
+_PAIR_SEPARATOR = "\n\n"
+
+
+@lru_cache(maxsize=8)
+def _get_encoding(model):
+    """取得模型對應的 tokenizer，無法載入時返回 None"""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding("cl100k_base")
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"載入 tokenizer 時出錯，改用字元數估算: {str(e)}")
+        return None
+
+
+def count_tokens(text, model=None):
+    """計算文字的 token 數量"""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        # 中文大約一個字一個 token，作為保守估計
+        return len(text)
+    return len(encoding.encode(text))
+
+
+def truncate_to_tokens(text, max_tokens, model=None):
+    """
+    將文字截斷到指定 token 數量以內
+
+    優先在換行或句號等位置斷開，只有第一句就超出時才直接按 token 截斷。
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return text
+
+    budget = max_tokens - count_tokens(_TRUNCATION_MARK, model)
+    if budget <= 0:
+        return ""
+
+    kept = ""
+    for segment in _BOUNDARY_PATTERN.split(text):
+        if count_tokens(kept + segment, model) > budget:
+            break
+        kept += segment
+
+    if not kept:
+        encoding = _get_encoding(model)
+        if encoding is None:
+            kept = text[:budget]
+        else:
+            # 多位元組字元可能被切在中間，去掉解碼失敗的字元
+            kept = encoding.decode(encoding.encode(text)[:budget]).replace("�", "")
+
+    return kept.rstrip() + _TRUNCATION_MARK
+
+
+def _pair_key(doc):
+    """
+    同一組問答對（問題文檔與問答文檔）使用相同的鍵
+
+    返回:
+    tuple: 問答對為 (問題, 答案)；沒有問答 metadata 的文檔為 (None, 文檔內容)
+    """
+    question = doc.metadata.get("question")
+    answer = doc.metadata.get("answer")
+    if question is None or answer is None:
+        return (None, doc.page_content)
+    return (question, answer)
+
+
+def build_context(docs_and_scores, max_tokens=1500, max_pairs=3, max_answer_tokens=600, model=None):
+    """
+    將搜索結果整理成提供給 LLM 的參考資料
+
+    參數:
+    docs_and_scores (list): (Document, 分數) 列表，需已按相關度排序（最相關的在前）
+    max_tokens (int): 參考資料的 token 上限
+    max_pairs (int): 最多放入幾組問答對
+    max_answer_tokens (int): 單一答案的 token 上限，None 表示不限制
+    model (str): 用於計算 token 的模型名稱
+
+    返回:
+    str: 去重並依 token 預算打包後的參考資料
+    """
+    seen = set()
+    sections = []
+    used_tokens = 0
+    separator_tokens = count_tokens(_PAIR_SEPARATOR, model)
+
+    for doc, _ in docs_and_scores:
+        if len(sections) >= max_pairs:
+            break
+
+        key = _pair_key(doc)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        if key[0] is None:
+            header, body = "", doc.page_content
+        else:
+            header, body = f"問題: {key[0]}\n答案: ", key[1]
+
+        if max_answer_tokens is not None:
+            body = truncate_to_tokens(body, max_answer_tokens, model)
+
+        remaining = max_tokens - used_tokens - (separator_tokens if sections else 0)
+        header_tokens = count_tokens(header, model)
+        section = header + body
+        section_tokens = count_tokens(section, model)
+
+        if section_tokens > remaining:
+            # 預算不足時截斷答案，剩餘空間太小則停止
+            body = truncate_to_tokens(body, remaining - header_tokens, model)
+            if not body:
+                break
+            section = header + body
+            section_tokens = count_tokens(section, model)
+
+        sections.append(section)
+        used_tokens += section_tokens + (separator_tokens if len(sections) > 1 else 0)
+
+        if used_tokens >= max_tokens:
+            break
+
+    return _PAIR_SEPARATOR.join(sections)
@@ -2,14 +2,58 @@ from langchain.memory import ConversationBufferMemory
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
+from embedding_cache import CachedEmbeddings, normalize_text
+from local_embeddings import CharNgramEmbeddings
+from context_builder import build_context
+from near_duplicates import NearDuplicateIndex, merge_entries
+from request_profiler import current_profile, start_request_profile
+import asyncio
+import concurrent.futures
 import os
 import json
+import threading
+import time
 import traceback
 from dotenv import load_dotenv
 
 load_dotenv()
+
+# 可由檢索設定檔（見 retrieval_sweep.py）調整的參數
+RETRIEVAL_CONFIG_KEYS = (
+    "search_k",
+    "context_top_n",
+    "context_token_budget",
+    "keyword_match_threshold",
+    "vector_direct_answer_threshold",
+    "retrieved_fallback_threshold",
+    "index_answer_docs",
+    "index_aliases",
+    "index_type",
+    "embedding_backend",
+)
+
+TIMEOUT_MESSAGE = "很抱歉，目前系統繁忙，暫時無法回答您的問題。請稍後再試或聯繫人工客服。"
+
+# 有時間預算時，各階段在此執行緒池中執行，超時後直接返回不再等待
+_stage_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ANSWER_STAGE_WORKERS", "32")), thread_name_prefix="cs-stage"
+)
+# 向量搜索使用獨立的執行緒池，避免卡住的 LLM 請求佔滿執行緒後連搜索也無法執行
+_search_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ANSWER_SEARCH_WORKERS", "16")), thread_name_prefix="cs-search"
+)
+
+
+class StageTimeout(Exception):
+    """回答流程中某個階段超過時間預算"""
+
+    def __init__(self, stage):
+        super().__init__(f"階段 {stage} 超過時間預算")
+        self.stage = stage
+
+
 class CustomerServiceAI:
-    def __init__(self, llm, qa_data=None, qa_file=None, model="gpt-3.5-turbo" ):
+    def __init__(self, llm, qa_data=None, qa_file=None, model="gpt-3.5-turbo", retrieval_config=None):
         self.llm = llm
         self.qa_data = qa_data or []
         self.memory = ConversationBufferMemory()
@@ -19,6 +63,39 @@ class CustomerServiceAI:
         self.api_key = os.environ.get("OPENAI_API_KEY")
         self.use_llm_refinement = False
         self.model = model
+        # 參考資料的 token 預算，控制提示長度以降低延遲與成本
+        self.context_token_budget = 1500
+        self.context_top_n = 3
+        self.context_answer_token_limit = 600
+        # 回答的時間預算（秒），None 表示不限時
+        self.latency_budget = None
+        # 時間用完時，向量搜索第一筆的距離不超過此值才使用其答案，否則返回 TIMEOUT_MESSAGE（None 表示不使用）
+        self.retrieved_fallback_threshold = 0.35
+        # 時間預算內使用的不重試 LLM 及各預算的查詢嵌入模型
+        self._budget_llm = None
+        self._budget_embeddings = {}
+        self.tier_counts = {}
+        self._tier_lock = threading.Lock()
+        # 新增問答對時判定為近似重複的相似度下限（問題與答案都須達到），None 表示只檢查完全相同的問題
+        self.near_duplicate_threshold = 0.85
+
+        # 檢索參數
+        self.search_k = 5
+        self.keyword_match_threshold = 2
+        # 向量搜索第一筆的距離不超過此值時直接使用其答案，不呼叫 LLM（None 表示不使用）
+        self.vector_direct_answer_threshold = None
+        self.index_answer_docs = True
+        self.index_aliases = True
+        # "flat"（精確搜索）、"hnsw"（近似搜索）或 "none"（只使用文字匹配）
+        self.index_type = "flat"
+        # "openai"、"openai:<模型名稱>" 或 "local"（本地字元 n-gram，不呼叫 API）
+        self.embedding_backend = "openai"
+
+        # 只載入明確指定的檢索設定（參數或 RETRIEVAL_CONFIG_FILE 環境變數），不自動讀取目錄中的檔案
+        if retrieval_config is None:
+            retrieval_config = os.environ.get("RETRIEVAL_CONFIG_FILE")
+        if retrieval_config:
+            self.load_retrieval_config(retrieval_config)
 
         # 如果提供了 Q&A 文件，則載入
         if qa_file:
@@ -31,17 +108,44 @@ class CustomerServiceAI:
         """載入 JSON 格式的 Q&A 資料"""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
-                self.qa_data = json.load(f)
-
-            # 建立向量索引
-            if self.qa_data:
-                self._build_vector_index()
-
-            return self.qa_data
+                return self.load_qa_data(json.load(f))
         except Exception as e:
             print(f"載入 JSON 文件時出錯: {str(e)}")
             return []
 
+    def load_retrieval_config(self, config):
+        """
+        載入檢索參數
+
+        參數:
+        config (str or dict): 設定檔路徑或設定內容。設定檔中有 "selected" 時使用其中的參數
+        """
+        try:
+            if isinstance(config, str):
+                with open(config, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            params = config.get("selected", config)
+            if not params:
+                print("檢索設定中沒有可用的參數（selected 為空），維持預設值")
+                return
+
+            for key in RETRIEVAL_CONFIG_KEYS:
+                if key in params:
+                    setattr(self, key, params[key])
+            print(f"已載入檢索設定: { {key: params[key] for key in RETRIEVAL_CONFIG_KEYS if key in params} }")
+        except Exception as e:
+            print(f"載入檢索設定時出錯: {str(e)}")
+
+    def load_qa_data(self, qa_data):
+        """載入已解析的 Q&A 資料並建立向量索引"""
+        self.qa_data = qa_data or []
+
+        # 建立向量索引
+        if self.qa_data and self.index_type != "none":
+            self._build_vector_index()
+
+        return self.qa_data
+
     def append_qa_to_json(self, new_qa_pairs, json_file_path="customer_service_qa.json"):
         """
         將新的問答對添加到現有的 JSON 文件中
@@ -51,7 +155,7 @@ class CustomerServiceAI:
         json_file_path (str): JSON 文件的路徑
 
         返回:
-        bool: 操作是否成功
+        tuple: (新增的問答對數量, 與既有問答對合併的近似重複數量)，出錯時為 (0, 0)
         """
         try:
             # 檢查文件是否存在
@@ -63,21 +167,43 @@ class CustomerServiceAI:
                 # 如果文件不存在，創建一個空列表
                 existing_qa_pairs = []
 
+            # 建立近似重複索引（同一份文件小幅修改後重複上傳時，不會累積幾乎相同的問答對）
+            duplicate_index = None
+            if self.near_duplicate_threshold is not None:
+                duplicate_index = NearDuplicateIndex(threshold=self.near_duplicate_threshold)
+                for i, qa in enumerate(existing_qa_pairs):
+                    duplicate_index.add(i, qa)
+
             # 檢查新問答對是否已存在，避免重複
             added_count = 0
+            merged_count = 0
             for new_qa in new_qa_pairs:
-                if not any(qa['question'] == new_qa['question'] for qa in existing_qa_pairs):
-                    existing_qa_pairs.append(new_qa)
-                    added_count += 1
+                if any(qa['question'] == new_qa['question'] for qa in existing_qa_pairs):
+                    continue
+
+                matches = duplicate_index.query(new_qa) if duplicate_index else []
+                if matches:
+                    # 近似重複：以新版本取代舊版本，舊的問題保留為別名
+                    i, similarity = matches[0]
+                    print(f"合併近似重複的問答對 (相似度 {similarity:.2f}): {existing_qa_pairs[i]['question']}")
+                    existing_qa_pairs[i] = merge_entries([existing_qa_pairs[i], new_qa])
+                    duplicate_index.add(i, existing_qa_pairs[i])
+                    merged_count += 1
+                    continue
+
+                existing_qa_pairs.append(new_qa)
+                if duplicate_index:
+                    duplicate_index.add(len(existing_qa_pairs) - 1, new_qa)
+                added_count += 1
 
             # 將更新後的問答對寫入 JSON 文件
             with open(json_file_path, 'w', encoding='utf-8') as file:
                 json.dump(existing_qa_pairs, file, ensure_ascii=False, indent=4)
 
-            return added_count
+            return added_count, merged_count
         except Exception as e:
             print(f"添加問答對到 JSON 文件時出錯: {str(e)}")
-            return 0
+            return 0, 0
 
     def load_word_file(self, file_path: str):
         """載入 Word 檔案並提取問答對"""
@@ -144,13 +270,16 @@ class CustomerServiceAI:
             # 如果有問答對，建立向量索引
             if self.qa_data:
                 # 將解析出的問答對添加到 JSON 文件
-                added_count = self.append_qa_to_json(self.qa_data)
+                added_count, merged_count = self.append_qa_to_json(self.qa_data)
 
                 if added_count > 0:
                     print(f"成功添加 {added_count} 個新問答對到知識庫！")
-                else:
+                if merged_count > 0:
+                    print(f"已更新 {merged_count} 個近似重複的既有問答對")
+                if added_count == 0 and merged_count == 0:
                     print("沒有新的問答對被添加，可能是因為所有問答對已存在。")
-                self._build_vector_index()
+                if self.index_type != "none":
+                    self._build_vector_index()
 
             return self.qa_data
 
@@ -165,8 +294,9 @@ class CustomerServiceAI:
         try:
             self.processing_status = {"status": "processing", "message": "正在建立向量索引..."}
 
-            # 初始化嵌入模型
-            self.embeddings = OpenAIEmbeddings()
+            # 初始化嵌入模型（經過快取，查詢與重建索引時重複的文字不需再次呼叫 API）
+            self.embeddings = CachedEmbeddings(self._create_embeddings())
+            self._budget_embeddings = {}
 
             # 準備文檔
             documents = []
@@ -178,15 +308,25 @@ class CustomerServiceAI:
                 )
                 documents.append(question_doc)
 
+                # 改寫的問法作為別名，指向同一個答案
+                for alias in (qa.get("aliases", []) if self.index_aliases else []):
+                    documents.append(Document(
+                        page_content=alias,
+                        metadata={"question": qa["question"], "answer": qa["answer"], "type": "alias"}
+                    ))
+
                 # 也可以選擇性地將答案加入索引
-                answer_doc = Document(
-                    page_content=f"問題: {qa['question']}\n答案: {qa['answer']}",
-                    metadata={"question": qa["question"], "answer": qa["answer"], "type": "answer"}
-                )
-                documents.append(answer_doc)
+                if self.index_answer_docs:
+                    answer_doc = Document(
+                        page_content=f"問題: {qa['question']}\n答案: {qa['answer']}",
+                        metadata={"question": qa["question"], "answer": qa["answer"], "type": "answer"}
+                    )
+                    documents.append(answer_doc)
 
             # 建立向量存儲
             self.vector_store = FAISS.from_documents(documents, self.embeddings)
+            if self.index_type == "hnsw":
+                self._convert_index_to_hnsw()
             self.vector_index_built = True
 
             self.processing_status = {"status": "completed", "message": "成功建立向量索引"}
@@ -196,12 +336,169 @@ class CustomerServiceAI:
             print(f"建立向量索引時出錯: {error_msg}")
             self.processing_status = {"status": "error", "message": f"建立向量索引時出錯: {str(e)}"}
 
-    def answer_question(self, question, debug_callback=None):
-        """回答用戶問題"""
+    def _create_embeddings(self, timeout=None):
+        """
+        依 embedding_backend 建立嵌入模型
+
+        參數:
+        timeout (float): API 請求的逾時秒數，指定時也不自動重試；None 使用預設值
+        """
+        backend = self.embedding_backend or "openai"
+        if backend == "local":
+            return CharNgramEmbeddings()
+        options = {"request_timeout": timeout, "max_retries": 0} if timeout is not None else {}
+        if backend.startswith("openai:"):
+            return OpenAIEmbeddings(model=backend.split(":", 1)[1], **options)
+        return OpenAIEmbeddings(**options)
+
+    def _query_embeddings(self, budget=None):
+        """查詢用的嵌入模型；有時間預算時請求逾時不超過預算且不重試，卡住的請求最多佔用搜索執行緒一個預算的時間"""
+        if budget is None or (self.embedding_backend or "openai") == "local":
+            return self.embeddings
+        with self._tier_lock:
+            embeddings = self._budget_embeddings.get(budget)
+            if embeddings is None:
+                # 與索引使用相同的快取，已查詢過的問題不需再次呼叫 API
+                embeddings = CachedEmbeddings(self._create_embeddings(timeout=budget))
+                self._budget_embeddings[budget] = embeddings
+        return embeddings
+
+    def _vector_search(self, question, budget=None):
+        """向量搜索，返回 (文檔, 距離) 列表"""
+        if budget is None:
+            return self.vector_store.similarity_search_with_score(question, self.search_k)
+        embedding = self._query_embeddings(budget).embed_query(question)
+        return self.vector_store.similarity_search_with_score_by_vector(embedding, self.search_k)
+
+    async def _avector_search(self, question, budget=None):
+        """非同步向量搜索，返回 (文檔, 距離) 列表"""
+        if budget is None:
+            return await self.vector_store.asimilarity_search_with_score(question, k=self.search_k)
+        embedding = await self._query_embeddings(budget).aembed_query(question)
+        return await self.vector_store.asimilarity_search_with_score_by_vector(embedding, k=self.search_k)
+
+    def _convert_index_to_hnsw(self):
+        """將精確搜索的索引換成 HNSW 近似搜索索引（文檔順序不變）"""
+        import faiss
+
+        flat_index = self.vector_store.index
+        hnsw_index = faiss.IndexHNSWFlat(flat_index.d, 32)
+        hnsw_index.hnsw.efSearch = 64
+        hnsw_index.add(flat_index.reconstruct_n(0, flat_index.ntotal))
+        self.vector_store.index = hnsw_index
+
+    def _make_debug(self, debug_callback):
+        """建立同時輸出到回調與終端機的調試函數"""
         def debug(message):
             if debug_callback:
                 debug_callback(message)
             print(message)
+        return debug
+
+    def _error_message(self, e, debug):
+        error_msg = traceback.format_exc()
+        debug(f"回答問題時出錯: {error_msg}")
+        return f"很抱歉，處理您的問題時出現了錯誤。請稍後再試或聯繫人工客服。錯誤詳情: {str(e)}"
+
+    def _remaining_time(self, deadline):
+        """距離截止時間的剩餘秒數，沒有截止時間時返回 None"""
+        if deadline is None:
+            return None
+        return deadline - time.monotonic()
+
+    def _run_stage(self, name, deadline, func, *args, executor=None):
+        """在剩餘時間內執行一個階段，超時則拋出 StageTimeout"""
+        remaining = self._remaining_time(deadline)
+        if remaining is None:
+            return func(*args)
+        if remaining <= 0:
+            raise StageTimeout(name)
+
+        # 效能分析中時，背景執行緒執行此階段期間也一併取樣
+        profile = current_profile()
+        if profile is not None:
+            func = profile.wrap(func, f"stage:{name}")
+
+        # 在背景執行緒中執行，超時後不再等待（該執行緒會自行結束）
+        future = (executor or _stage_executor).submit(func, *args)
+        try:
+            if profile is not None:
+                # 等待期間只取樣執行階段的執行緒
+                with profile.waiting():
+                    return future.result(timeout=remaining)
+            return future.result(timeout=remaining)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise StageTimeout(name)
+
+    async def _arun_stage(self, name, deadline, awaitable):
+        """在剩餘時間內等待一個階段，超時則拋出 StageTimeout"""
+        remaining = self._remaining_time(deadline)
+        if remaining is None:
+            return await awaitable
+        if remaining <= 0:
+            awaitable.close()
+            raise StageTimeout(name)
+        try:
+            return await asyncio.wait_for(awaitable, timeout=remaining)
+        except asyncio.TimeoutError:
+            raise StageTimeout(name)
+
+    def _finish(self, answer, tier, started, debug):
+        """記錄服務此回答的層級並整理結果"""
+        elapsed = time.monotonic() - started
+        with self._tier_lock:
+            self.tier_counts[tier] = self.tier_counts.get(tier, 0) + 1
+        debug(f"回答層級: {tier}，耗時 {elapsed:.2f} 秒")
+        return {"answer": answer, "tier": tier, "elapsed": elapsed}
+
+    def _degraded(self, best, started, debug):
+        """時間用完時返回目前最好的答案"""
+        if best is not None:
+            debug(f"時間預算用完，使用目前最好的答案（{best[1]}）")
+            return self._finish(best[0], best[1], started, debug)
+        debug("時間預算用完，且沒有可用的答案")
+        return self._finish(TIMEOUT_MESSAGE, "timeout", started, debug)
+
+    def get_tier_stats(self):
+        """各回答層級的服務次數"""
+        with self._tier_lock:
+            return dict(self.tier_counts)
+
+    def answer_question(self, question, debug_callback=None, latency_budget=None, profile=False):
+        """回答用戶問題"""
+        return self.answer_question_with_details(question, debug_callback, latency_budget, profile)["answer"]
+
+    def answer_question_with_details(self, question, debug_callback=None, latency_budget=None, profile=False):
+        """
+        回答用戶問題，並返回服務此回答的層級
+
+        每個階段（直接匹配、關鍵詞、向量搜索、LLM 生成、修飾）都在剩餘的時間預算內執行，
+        時間用完時返回目前最好的答案，例如向量搜索的第一筆答案或未修飾的直接匹配結果。
+
+        參數:
+        question (str): 用戶問題
+        debug_callback (callable): 調試訊息回調
+        latency_budget (float): 時間預算（秒），None 時使用 self.latency_budget，仍為 None 則不限時
+        profile (bool): 是否對此次回答進行效能分析（也會依 PROFILE_SAMPLE_RATE 取樣）
+
+        返回:
+        dict: {"answer": 回答, "tier": 服務層級, "elapsed": 耗時秒數}，進行效能分析時另有 "profile" 記錄
+        """
+        with start_request_profile("answer_question", requested=profile) as profiler:
+            result = self._answer_question_with_details(question, debug_callback, latency_budget)
+
+        if profiler.enabled:
+            result["profile"] = profiler.save()
+            self._make_debug(debug_callback)(f"效能分析:\n{result['profile']['summary']}")
+        return result
+
+    def _answer_question_with_details(self, question, debug_callback, latency_budget):
+        debug = self._make_debug(debug_callback)
+        started = time.monotonic()
+        budget = latency_budget if latency_budget is not None else self.latency_budget
+        deadline = started + budget if budget is not None else None
+        best = None
 
         try:
             debug(f"處理問題: {question}")
@@ -212,85 +509,258 @@ class CustomerServiceAI:
                 debug("使用直接文本匹配的結果")
                 debug(self.use_llm_refinement)
                 if self.use_llm_refinement:
-                    refined_answer = self.refine_answer_with_llm(exact_match, question)
+                    best = (exact_match, "exact")
+                    refined_answer = self._run_stage(
+                        "refinement", deadline, self.refine_answer_with_llm,
+                        exact_match, question, self._remaining_time(deadline)
+                    )
                     debug("答案已經過 LLM 修飾")
-                    return refined_answer
+                    # 修飾失敗時 refine_answer_with_llm 會返回原始答案
+                    tier = "exact_refined" if refined_answer != exact_match else "exact"
+                    return self._finish(refined_answer, tier, started, debug)
                 else:
                     debug("未使用 LLM 修飾")
-                    return exact_match
+                    return self._finish(exact_match, "exact", started, debug)
+
+            # 關鍵詞匹配，有向量索引時先嘗試向量搜索，關鍵詞答案作為備用
+            keyword_answer = self._keyword_match(question, debug)
+            if keyword_answer:
+                best = (keyword_answer, "keyword")
 
             # 如果已建立向量索引，使用向量搜索
             if self.vector_index_built:
                 debug(f"使用向量搜索回答問題: {question}")
 
                 # 使用 similarity_search_with_score 獲取分數
-                docs_and_scores = self.vector_store.similarity_search_with_score(question, k=5)
+                docs_and_scores = self._run_stage(
+                    "vector_search", deadline, self._vector_search, question, budget, executor=_search_executor
+                )
+                relevant_docs = self._collect_relevant_docs(docs_and_scores, debug)
 
-                # 打印搜索結果以便調試
-                debug("找到的相關文檔:")
-                relevant_docs = []
-                for i, (doc, score) in enumerate(docs_and_scores):
-                    debug_msg = f"文檔 {i+1}:\n內容: {doc.page_content}\n相似度分數: {score}"
-                    debug(debug_msg)
+                # 如果找到了文檔，使用 LLM 生成回答
+                if relevant_docs:
+                    direct_answer = self._direct_vector_answer(relevant_docs, debug)
+                    if direct_answer:
+                        return self._finish(direct_answer, "vector_direct", started, debug)
+
+                    # 已有關鍵詞答案時保留，否則只在距離夠近時使用向量搜索第一筆的答案
+                    best = best or self._retrieved_answer(relevant_docs, debug)
+                    context = self._build_context(relevant_docs, debug)
+                    response = self._run_stage("generation", deadline, self._rag_chain(self._remaining_time(deadline)).invoke, {
+                        "context": context,
+                        "question": question
+                    })
+                    return self._finish(response, "rag_llm", started, debug)
+
+            # 向量搜索沒有結果或未建立索引時，使用關鍵詞匹配的答案
+            if keyword_answer:
+                return self._finish(keyword_answer, "keyword", started, debug)
+
+            # 如果向量搜索失敗或未建立索引，使用 LLM 生成通用回答
+            debug("沒有找到匹配的問答對，使用 LLM 生成通用回答")
+            response = self._run_stage("generation", deadline, self._fallback_chain(self._remaining_time(deadline)).invoke, {
+                "question": question
+            })
+            return self._finish(response, "llm", started, debug)
+
+        except StageTimeout as e:
+            debug(f"階段 {e.stage} 超過時間預算")
+            return self._degraded(best, started, debug)
+        except Exception as e:
+            if best is not None:
+                debug(f"回答問題時出錯，使用目前最好的答案: {str(e)}")
+                return self._finish(best[0], best[1], started, debug)
+            return self._finish(self._error_message(e, debug), "error", started, debug)
+
+    async def aanswer_question(self, question, debug_callback=None, latency_budget=None):
+        """回答用戶問題（非同步版本，網路請求不會佔用執行緒）"""
+        result = await self.aanswer_question_with_details(question, debug_callback, latency_budget)
+        return result["answer"]
+
+    async def aanswer_question_with_details(self, question, debug_callback=None, latency_budget=None):
+        """回答用戶問題並返回服務層級（非同步版本，參數與 answer_question_with_details 相同）"""
+        debug = self._make_debug(debug_callback)
+        started = time.monotonic()
+        budget = latency_budget if latency_budget is not None else self.latency_budget
+        deadline = started + budget if budget is not None else None
+        best = None
 
-                    # 收集所有文檔
-                    relevant_docs.append((doc, score))
+        try:
+            debug(f"處理問題: {question}")
 
-                # 按相似度排序
-                relevant_docs.sort(key=lambda x: x[1])
+            exact_match = self._exact_match_search(question, debug)
+            if exact_match:
+                debug("使用直接文本匹配的結果")
+                if self.use_llm_refinement:
+                    best = (exact_match, "exact")
+                    refined_answer = await self._arun_stage("refinement", deadline, self.arefine_answer_with_llm(
+                        exact_match, question, self._remaining_time(deadline)
+                    ))
+                    debug("答案已經過 LLM 修飾")
+                    tier = "exact_refined" if refined_answer != exact_match else "exact"
+                    return self._finish(refined_answer, tier, started, debug)
+                else:
+                    debug("未使用 LLM 修飾")
+                    return self._finish(exact_match, "exact", started, debug)
+
+            keyword_answer = self._keyword_match(question, debug)
+            if keyword_answer:
+                best = (keyword_answer, "keyword")
+
+            if self.vector_index_built:
+                debug(f"使用向量搜索回答問題: {question}")
+
+                docs_and_scores = await self._arun_stage(
+                    "vector_search", deadline, self._avector_search(question, budget)
+                )
+                relevant_docs = self._collect_relevant_docs(docs_and_scores, debug)
 
-                # 如果找到了文檔
                 if relevant_docs:
-                    # 使用最相關的文檔作為上下文
-                    context = "\n\n".join([doc.page_content for doc, _ in relevant_docs[:3]])
+                    direct_answer = self._direct_vector_answer(relevant_docs, debug)
+                    if direct_answer:
+                        return self._finish(direct_answer, "vector_direct", started, debug)
+
+                    # 已有關鍵詞答案時保留，否則只在距離夠近時使用向量搜索第一筆的答案
+                    best = best or self._retrieved_answer(relevant_docs, debug)
+                    context = self._build_context(relevant_docs, debug)
+                    response = await self._arun_stage("generation", deadline, self._rag_chain(self._remaining_time(deadline)).ainvoke({
+                        "context": context,
+                        "question": question
+                    }))
+                    return self._finish(response, "rag_llm", started, debug)
+
+            if keyword_answer:
+                return self._finish(keyword_answer, "keyword", started, debug)
 
-                    debug(f"使用上下文:\n{context}")
+            debug("沒有找到匹配的問答對，使用 LLM 生成通用回答")
+            response = await self._arun_stage("generation", deadline, self._fallback_chain(self._remaining_time(deadline)).ainvoke({
+                "question": question
+            }))
+            return self._finish(response, "llm", started, debug)
 
-                    # 使用 LLM 生成回答
-                    from langchain_core.prompts import PromptTemplate
-                    from langchain_core.output_parsers import StrOutputParser
+        except StageTimeout as e:
+            debug(f"階段 {e.stage} 超過時間預算")
+            return self._degraded(best, started, debug)
+        except Exception as e:
+            if best is not None:
+                debug(f"回答問題時出錯，使用目前最好的答案: {str(e)}")
+                return self._finish(best[0], best[1], started, debug)
+            return self._finish(self._error_message(e, debug), "error", started, debug)
+
+    def _direct_vector_answer(self, relevant_docs, debug=print):
+        """最相關文檔的距離夠小時，直接使用其原始答案而不呼叫 LLM"""
+        if self.vector_direct_answer_threshold is None:
+            return None
+        doc, score = relevant_docs[0]
+        if score <= self.vector_direct_answer_threshold and doc.metadata.get("answer"):
+            debug(f"最相關文檔距離 {score} 低於門檻 {self.vector_direct_answer_threshold}，直接使用其答案")
+            return doc.metadata["answer"]
+        return None
 
-                    template = """
-                    你是一個專業的客服助手。請根據以下參考資料回答用戶的問題。
-                    如果參考資料中有直接相關的答案，請使用該答案。
-                    如果參考資料中沒有相關信息，請誠實地說你不知道，不要編造答案。
+    def _retrieved_answer(self, relevant_docs, debug=print):
+        """向量搜索最相關文檔的原始答案，作為 LLM 逾時時的備用答案；距離超過門檻時不使用，避免答非所問"""
+        doc, score = relevant_docs[0]
+        answer = doc.metadata.get("answer")
+        if not answer or self.retrieved_fallback_threshold is None:
+            return None
+        if score > self.retrieved_fallback_threshold:
+            debug(f"最相關文檔距離 {score} 超過門檻 {self.retrieved_fallback_threshold}，不作為備用答案")
+            return None
+        return (answer, "retrieved")
+
+    def _collect_relevant_docs(self, docs_and_scores, debug=print):
+        """整理向量搜索結果，並按相似度排序"""
+        # 打印搜索結果以便調試
+        debug("找到的相關文檔:")
+        relevant_docs = []
+        for i, (doc, score) in enumerate(docs_and_scores):
+            debug_msg = f"文檔 {i+1}:\n內容: {doc.page_content}\n相似度分數: {score}"
+            debug(debug_msg)
+
+            # 收集所有文檔
+            relevant_docs.append((doc, score))
+
+        # 按相似度排序
+        relevant_docs.sort(key=lambda x: x[1])
+        return relevant_docs
+
+    def _build_context(self, relevant_docs, debug=print):
+        """使用最相關的文檔作為上下文（按問答對去重，並依 token 預算打包）"""
+        context = build_context(
+            relevant_docs,
+            max_tokens=self.context_token_budget,
+            max_pairs=self.context_top_n,
+            max_answer_tokens=self.context_answer_token_limit,
+            model=getattr(self.llm, "model_name", None),
+        )
+        debug(f"使用上下文:\n{context}")
+        return context
 
-                    參考資料:
-                    {context}
+    def _no_retry_llm(self):
+        """
+        時間預算內使用的 LLM
 
-                    用戶問題: {question}
+        OpenAI SDK 預設會重試兩次，每次重試都重新計算逾時，請求可能超過時間預算仍佔用執行緒，
+        因此複製一份 max_retries=0 的 LLM；不支援 max_retries 的模型直接使用原本的 LLM。
+        """
+        if self._budget_llm is not None and self._budget_llm[0] is self.llm:
+            return self._budget_llm[1]
+
+        llm = self.llm
+        if "max_retries" in getattr(type(llm), "model_fields", {}):
+            try:
+                fields = llm.model_dump(exclude={
+                    "client", "async_client", "root_client", "root_async_client", "http_client", "http_async_client"
+                })
+                llm = type(llm)(**{**fields, "max_retries": 0})
+            except Exception as e:
+                print(f"建立不重試的 LLM 時出錯，使用原本的 LLM: {str(e)}")
+                llm = self.llm
+        self._budget_llm = (self.llm, llm)
+        return llm
+
+    def _bounded_llm(self, timeout=None):
+        """以剩餘時間作為 LLM 請求的逾時且不重試，超過時間預算的請求不會繼續佔用執行緒"""
+        if timeout is None:
+            return self.llm
+        return self._no_retry_llm().bind(timeout=max(timeout, 0.001))
+
+    def _rag_chain(self, timeout=None):
+        """根據參考資料回答問題的 LLM 鏈"""
+        from langchain_core.prompts import PromptTemplate
+        from langchain_core.output_parsers import StrOutputParser
 
-                    請提供專業、有禮貌且有幫助的回答:
-                    """
+        template = """
+        你是一個專業的客服助手。請根據以下參考資料回答用戶的問題。
+        如果參考資料中有直接相關的答案，請使用該答案。
+        如果參考資料中沒有相關信息，請誠實地說你不知道，不要編造答案。
 
-                    prompt = PromptTemplate(
-                        template=template,
-                        input_variables=["context", "question"]
-                    )
+        參考資料:
+        {context}
 
-                    chain = prompt | self.llm | StrOutputParser()
+        用戶問題: {question}
 
-                    response = chain.invoke({
-                        "context": context,
-                        "question": question
-                    })
+        請提供專業、有禮貌且有幫助的回答:
+        """
 
-                    return response
+        prompt = PromptTemplate(
+            template=template,
+            input_variables=["context", "question"]
+        )
 
-            # 如果向量搜索失敗或未建立索引，使用備用方法
-            debug("使用備用方法")
-            return self._fallback_answer(question, debug)
+        return prompt | self._bounded_llm(timeout) | StrOutputParser()
 
-        except Exception as e:
-            error_msg = traceback.format_exc()
-            debug(f"回答問題時出錯: {error_msg}")
-            return f"很抱歉，處理您的問題時出現了錯誤。請稍後再試或聯繫人工客服。錯誤詳情: {str(e)}"
+    def _question_variants(self, qa):
+        """問答對的問題及離線產生的改寫問法"""
+        return [qa["question"]] + list(qa.get("aliases", []))
 
     def _exact_match_search(self, question, debug=print):
         """嘗試直接文本匹配"""
         question_lower = question.lower()
         debug(f"進行直接文本匹配: {question_lower}")
 
+        question_key = normalize_text(question)
+
         for qa in self.qa_data:
             qa_question_lower = qa["question"].lower()
 
@@ -311,12 +781,17 @@ class CustomerServiceAI:
                     debug(f"找到關鍵詞匹配: {qa['question']} (關鍵詞: {keyword})")
                     return qa["answer"]
 
+            # 改寫問法（aliases）較短且籠統，只在正規化後完全相同時匹配，避免部分匹配誤中其他問題
+            for alias in qa.get("aliases", []):
+                if question_key == normalize_text(alias):
+                    debug(f"找到改寫問法匹配: {alias}")
+                    return qa["answer"]
+
         debug("沒有找到直接文本匹配")
         return None
 
-    def _fallback_answer(self, question, debug=print):
-        """當向量搜索失敗時的備用方法"""
-        # 嘗試直接關鍵詞匹配
+    def _keyword_match(self, question, debug=print):
+        """關鍵詞匹配，匹配度足夠高時返回答案，否則返回 None"""
         debug("使用關鍵詞匹配方法")
 
         # 將問題轉換為關鍵詞集合
@@ -327,27 +802,29 @@ class CustomerServiceAI:
         highest_match_count = 0
 
         for qa in self.qa_data:
-            # 將問題轉換為關鍵詞集合
-            qa_words = set(qa["question"].lower().split())
+            for variant in self._question_variants(qa):
+                # 將問題轉換為關鍵詞集合
+                qa_words = set(variant.lower().split())
 
-            # 計算匹配的關鍵詞數量
-            match_count = len(question_words.intersection(qa_words))
+                # 計算匹配的關鍵詞數量
+                match_count = len(question_words.intersection(qa_words))
 
-            if match_count > highest_match_count:
-                highest_match_count = match_count
-                best_match = qa
-                debug(f"找到更好的匹配: '{qa['question']}', 匹配關鍵詞數量: {match_count}")
+                if match_count > highest_match_count:
+                    highest_match_count = match_count
+                    best_match = qa
+                    debug(f"找到更好的匹配: '{variant}', 匹配關鍵詞數量: {match_count}")
 
         # 如果匹配度足夠高
-        if highest_match_count >= 2 and best_match:
+        if highest_match_count >= self.keyword_match_threshold and best_match:
             debug(f"使用關鍵詞匹配結果: '{best_match['question']}'")
             debug(f"匹配關鍵詞數量: {highest_match_count}")
             return best_match["answer"]
-        else:
-            debug(f"關鍵詞匹配不足: 最高匹配數 {highest_match_count}")
 
-        # 如果沒有找到匹配的問答對，使用 LLM 生成通用回答
-        debug("沒有找到匹配的問答對，使用 LLM 生成通用回答")
+        debug(f"關鍵詞匹配不足: 最高匹配數 {highest_match_count}")
+        return None
+
+    def _fallback_chain(self, timeout=None):
+        """沒有參考資料時生成通用回答的 LLM 鏈"""
         from langchain_core.prompts import PromptTemplate
         from langchain_core.output_parsers import StrOutputParser
 
@@ -365,14 +842,7 @@ class CustomerServiceAI:
             input_variables=["question"]
         )
 
-        chain = prompt | self.llm | StrOutputParser()
-
-        debug("使用 LLM 生成回答")
-        response = chain.invoke({
-            "question": question
-        })
-
-        return response
+        return prompt | self._bounded_llm(timeout) | StrOutputParser()
 
     def _calculate_similarity(self, text1, text2):
         """計算兩個文本的相似度 (簡單版本)"""
@@ -415,13 +885,32 @@ class CustomerServiceAI:
 
         return None
 
-    def refine_answer_with_llm(self, original_answer, question):
+    def _refine_messages(self, original_answer, question):
+        """構建修飾答案用的對話訊息"""
+        prompt = f"""
+        請優化以下客服回答，使其更專業、親切且易於理解。保持原始資訊完整，但改善用詞、語氣和結構。
+
+        用戶問題: {question}
+
+        原始回答:
+        {original_answer}
+
+        優化後的回答:
+        """
+
+        return [
+            {"role": "system", "content": "你是一位專業的客服優化專家，擅長將回答修飾得更加專業、親切且易於理解。"},
+            {"role": "user", "content": prompt}
+        ]
+
+    def refine_answer_with_llm(self, original_answer, question, timeout=None):
         """
         使用 LLM 修飾答案，優化用詞和語氣
 
         參數:
         original_answer (str): 原始答案
         question (str): 用戶問題
+        timeout (float): API 請求的逾時秒數，None 使用預設值
 
         返回:
         str: 修飾後的答案
@@ -434,27 +923,15 @@ class CustomerServiceAI:
             if not hasattr(self, 'openai_client'):
                 self.openai_client = openai.OpenAI(api_key=self.api_key)
 
-            # 構建提示
-            prompt = f"""
-            請優化以下客服回答，使其更專業、親切且易於理解。保持原始資訊完整，但改善用詞、語氣和結構。
-
-            用戶問題: {question}
-
-            原始回答:
-            {original_answer}
-
-            優化後的回答:
-            """
-
             # 調用 LLM
-            response = self.openai_client.chat.completions.create(
+            # 有逾時時不重試，避免重試使請求超過時間預算
+            client = self.openai_client if timeout is None else self.openai_client.with_options(max_retries=0)
+            response = client.chat.completions.create(
                 model=self.model,  # 使用您設置的模型
-                messages=[
-                    {"role": "system", "content": "你是一位專業的客服優化專家，擅長將回答修飾得更加專業、親切且易於理解。"},
-                    {"role": "user", "content": prompt}
-                ],
+                messages=self._refine_messages(original_answer, question),
                 temperature=0.5,  # 較低的溫度以保持一致性
-                max_tokens=1000
+                max_tokens=1000,
+                **({"timeout": timeout} if timeout is not None else {})
             )
 
             # 獲取修飾後的答案
@@ -465,3 +942,27 @@ class CustomerServiceAI:
             print(f"使用 LLM 修飾答案時出錯: {str(e)}")
             # 如果出錯，返回原始答案
             return original_answer
+
+    async def arefine_answer_with_llm(self, original_answer, question, timeout=None):
+        """使用 LLM 修飾答案（非同步版本，使用 AsyncOpenAI）"""
+        try:
+            import openai
+
+            if not hasattr(self, 'async_openai_client'):
+                self.async_openai_client = openai.AsyncOpenAI(api_key=self.api_key)
+
+            client = self.async_openai_client
+            if timeout is not None:
+                client = client.with_options(max_retries=0)
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=self._refine_messages(original_answer, question),
+                temperature=0.5,
+                max_tokens=1000,
+                **({"timeout": timeout} if timeout is not None else {})
+            )
+
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            print(f"使用 LLM 修飾答案時出錯: {str(e)}")
+            return original_answer
@@ -0,0 +1,178 @@
+from langchain_core.embeddings import Embeddings
+from collections import OrderedDict
+from array import array
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+
+def normalize_text(text):
+    """將文字正規化作為快取鍵（全半形統一、去除多餘空白、轉小寫）"""
+    text = unicodedata.normalize("NFKC", text or "")
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.lower()
+
+
+class EmbeddingCache:
+    """
+    嵌入向量快取：記憶體 LRU 層 + 可選的 SQLite 持久層
+
+    參數:
+    max_entries (int): 記憶體層最多保留的向量數量
+    db_path (str): SQLite 檔案路徑，None 表示只使用記憶體層
+    """
+
+    def __init__(self, max_entries=10000, db_path=None):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, text))"
+            )
+            self._conn.commit()
+
+    def get(self, model, text):
+        """取得快取的向量，找不到時返回 None"""
+        key = (model, normalize_text(text))
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return list(vector)
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT vector FROM embeddings WHERE model = ? AND text = ?", key
+                ).fetchone()
+                if row is not None:
+                    vector = array("f")
+                    vector.frombytes(row[0])
+                    self._remember(key, vector)
+                    self.stats["disk_hits"] += 1
+                    return list(vector)
+
+            self.stats["misses"] += 1
+            return None
+
+    def put_many(self, model, items):
+        """批次寫入 (文字, 向量) 到快取"""
+        rows = []
+        with self._lock:
+            for text, vector in items:
+                key = (model, normalize_text(text))
+                packed = array("f", vector)
+                self._remember(key, packed)
+                rows.append((key[0], key[1], packed.tobytes()))
+
+            if self._conn is not None and rows:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, text, vector) VALUES (?, ?, ?)", rows
+                )
+                self._conn.commit()
+
+    def put(self, model, text, vector):
+        """寫入單一向量到快取"""
+        self.put_many(model, [(text, vector)])
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        """清空記憶體層（持久層保留）"""
+        with self._lock:
+            self._memory.clear()
+
+    def __len__(self):
+        return len(self._memory)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    在任意 LangChain 嵌入模型前加上快取
+
+    查詢與建立索引共用同一個快取，重建索引時未變動的問答文字不需重新嵌入。
+    """
+
+    def __init__(self, embeddings, cache=None, model_name=None):
+        self.embeddings = embeddings
+        self.cache = cache if cache is not None else get_default_embedding_cache()
+        self.model_name = model_name or getattr(embeddings, "model", None) or type(embeddings).__name__
+
+    def _split_hits(self, texts):
+        """返回已快取的向量列表（未命中為 None）及需要嵌入的文字"""
+        vectors = [self.cache.get(self.model_name, text) for text in texts]
+        missing = OrderedDict()
+        for text, vector in zip(texts, vectors):
+            if vector is None:
+                # 正規化後相同的文字只嵌入一次
+                missing.setdefault(normalize_text(text), text)
+        return vectors, list(missing.values())
+
+    def _merge(self, texts, vectors, missing_texts, missing_vectors):
+        self.cache.put_many(self.model_name, zip(missing_texts, missing_vectors))
+        fresh = {normalize_text(text): vector for text, vector in zip(missing_texts, missing_vectors)}
+        return [vector if vector is not None else list(fresh[normalize_text(text)])
+                for text, vector in zip(texts, vectors)]
+
+    def embed_documents(self, texts):
+        vectors, missing_texts = self._split_hits(texts)
+        missing_vectors = self.embeddings.embed_documents(missing_texts) if missing_texts else []
+        return self._merge(texts, vectors, missing_texts, missing_vectors)
+
+    def embed_query(self, text):
+        vector = self.cache.get(self.model_name, text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put(self.model_name, text, vector)
+        return vector
+
+    async def aembed_documents(self, texts):
+        vectors, missing_texts = self._split_hits(texts)
+        missing_vectors = await self.embeddings.aembed_documents(missing_texts) if missing_texts else []
+        return self._merge(texts, vectors, missing_texts, missing_vectors)
+
+    async def aembed_query(self, text):
+        vector = self.cache.get(self.model_name, text)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            self.cache.put(self.model_name, text, vector)
+        return vector
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_embedding_cache():
+    """
+    取得行程共用的嵌入快取
+
+    可透過環境變數設定:
+    EMBEDDING_CACHE_SIZE: 記憶體層最多保留的向量數量 (預設 10000)
+    EMBEDDING_CACHE_PATH: SQLite 持久層檔案路徑 (未設定則只使用記憶體層)
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache(
+                max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000")),
+                db_path=os.environ.get("EMBEDDING_CACHE_PATH") or None,
+            )
+        return _default_cache
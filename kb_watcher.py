@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+
+
+class KnowledgeBaseSnapshot:
+    """
+    某一版本的知識庫與其對應的客服助手
+
+    快照建立後不再修改。處理請求時先取得當下的快照，整個請求都使用同一個
+    快照，即使期間知識庫被替換，也不會讀到新舊混合的狀態。
+    """
+
+    def __init__(self, version, content_hash, assistant, qa_count):
+        self.version = version
+        self.content_hash = content_hash
+        self.assistant = assistant
+        self.qa_count = qa_count
+        self.loaded_at = time.time()
+
+    def describe(self):
+        return {
+            "version": self.version,
+            "content_hash": self.content_hash,
+            "qa_count": self.qa_count,
+            "loaded_at": self.loaded_at,
+        }
+
+
+class KnowledgeBaseWatcher:
+    """
+    監看 Q&A 知識庫檔案，變更時在背景重建助手並原子性地替換
+
+    參數:
+    qa_file (str): 知識庫 JSON 檔案路徑
+    build_assistant (callable): 接收 Q&A 資料列表並返回已建立索引的客服助手
+    poll_interval (float): 檢查檔案變更的間隔秒數，0 表示不自動檢查
+    """
+
+    def __init__(self, qa_file, build_assistant, poll_interval=5.0):
+        self.qa_file = qa_file
+        self.build_assistant = build_assistant
+        self.poll_interval = poll_interval
+        self.status = {"status": "idle", "message": ""}
+        self._snapshot = None
+        self._version = 0
+        self._file_stat = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._reload_pending = False
+        self._stop_event = threading.Event()
+        self._poll_thread = None
+
+    def start(self):
+        """同步建立第一個版本，並啟動背景檢查"""
+        if self._snapshot is None:
+            self.reload(wait=True)
+        with self._lock:
+            if self.poll_interval and self._poll_thread is None:
+                self._poll_thread = threading.Thread(target=self._poll_loop, daemon=True)
+                self._poll_thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+
+    def current(self):
+        """取得目前服務中的知識庫快照"""
+        if self._snapshot is None:
+            self.start()
+        return self._snapshot
+
+    @property
+    def assistant(self):
+        return self.current().assistant
+
+    def _poll_loop(self):
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                self.check_for_changes()
+            except Exception:
+                print(f"檢查知識庫變更時出錯: {traceback.format_exc()}")
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.qa_file)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def check_for_changes(self):
+        """檔案的修改時間或大小改變時觸發背景重建，返回是否觸發"""
+        if self._stat() == self._file_stat:
+            return False
+        return self.reload(wait=False)
+
+    def reload(self, wait=False, force=False):
+        """
+        重新載入知識庫
+
+        參數:
+        wait (bool): 是否等待重建完成
+        force (bool): 內容未改變時也強制重建
+
+        返回:
+        bool: 是否已開始（或完成）重建
+        """
+        if wait:
+            with self._reload_lock:
+                self._reload(force)
+            return True
+
+        if not self._reload_lock.acquire(blocking=False):
+            # 已在重建中，完成後再檢查一次
+            self._reload_pending = True
+            return False
+
+        def run():
+            try:
+                self._reload(force)
+                while self._reload_pending:
+                    self._reload_pending = False
+                    self._reload(False)
+            finally:
+                self._reload_lock.release()
+
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    def _reload(self, force):
+        stat = self._stat()
+        try:
+            if stat is None:
+                # 檔案暫時不存在（例如編輯器刪除後重寫）時保留目前版本，只有第一次載入使用空知識庫
+                if self._snapshot is not None:
+                    raise FileNotFoundError(f"找不到知識庫檔案 {self.qa_file}，繼續使用目前版本")
+                content = b"[]"
+            else:
+                with open(self.qa_file, "rb") as f:
+                    content = f.read()
+
+            content_hash = hashlib.sha256(content).hexdigest()
+            current = self._snapshot
+            if current is not None and current.content_hash == content_hash and not force:
+                self._file_stat = stat
+                return current
+
+            # 檔案可能寫到一半，解析失敗時保留舊版本
+            qa_data = json.loads(content.decode("utf-8"))
+
+            self.status = {"status": "processing", "message": f"正在建立知識庫新版本（{len(qa_data)} 個問答對）..."}
+            assistant = self.build_assistant(qa_data)
+
+            # 已有可用版本時，建立失敗的新版本不會取代它
+            processing_status = getattr(assistant, "processing_status", {})
+            if processing_status.get("status") == "error" and current is not None:
+                raise RuntimeError(processing_status.get("message"))
+
+            with self._lock:
+                self._version += 1
+                snapshot = KnowledgeBaseSnapshot(self._version, content_hash, assistant, len(qa_data))
+                # 單一參照的替換是原子操作，進行中的請求仍持有舊快照
+                self._snapshot = snapshot
+                self._file_stat = stat
+
+            self.status = {"status": "completed", "message": f"已載入知識庫版本 {snapshot.version}"}
+            print(f"知識庫已更新至版本 {snapshot.version}，包含 {snapshot.qa_count} 個問答對")
+            return snapshot
+        except Exception as e:
+            print(f"重新載入知識庫時出錯: {traceback.format_exc()}")
+            self.status = {"status": "error", "message": f"重新載入知識庫時出錯: {str(e)}"}
+            if self._snapshot is None:
+                raise
+            # 同一份內容不再重試，等檔案再次變更或手動強制重新載入
+            self._file_stat = stat
+            return self._snapshot
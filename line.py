@@ -1,5 +1,8 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, abort
 import requests
+import base64
+import hashlib
+import hmac
 import os
 import time
 import json
@@ -7,6 +10,8 @@ import os
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from customer_service_ai import CustomerServiceAI
+from kb_watcher import KnowledgeBaseWatcher
+from request_profiler import start_request_profile, recent_profiles
 
 load_dotenv()
 
@@ -14,29 +19,56 @@ app = Flask(__name__)
 
 # LINE Messaging API的設置
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESSTOKEN")
-LINE_API_URL = 'https://api.line.me/v2/bot/message/reply'
+LINE_CHANNEL_SECRET = os.getenv("CHANNEL_SECRET")
+LINE_API_URL = os.getenv("LINE_API_URL", 'https://api.line.me/v2/bot/message/reply')
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+QA_FILE = "customer_service_qa.json"
+# 每個問題的時間預算（秒），須在 LINE reply token 失效前回覆
+ANSWER_LATENCY_BUDGET = float(os.getenv("ANSWER_LATENCY_BUDGET", "20"))
 
 def initialize_llm():
     return ChatOpenAI(model="gpt-4o")
 
-def initialize_customer_service():
-    llm = initialize_llm()
+def build_customer_service(qa_data):
+    cs_assistant = CustomerServiceAI(initialize_llm())
+    cs_assistant.latency_budget = ANSWER_LATENCY_BUDGET
+    cs_assistant.load_qa_data(qa_data)
+    return cs_assistant
 
-    # 預設 Q&A 資料
-    default_qa = []
+# 知識庫檔案變更時在背景重建並替換，不需重啟服務
+kb_watcher = KnowledgeBaseWatcher(
+    QA_FILE, build_customer_service, poll_interval=float(os.getenv("KB_POLL_INTERVAL", "5"))
+)
 
-    # 檢查是否有 Q&A 檔案
-    qa_file = "customer_service_qa.json"
-    if os.path.exists(qa_file):
-        return CustomerServiceAI(llm, qa_file=qa_file)
-    else:
-        return CustomerServiceAI(llm, qa_data=default_qa)
+def initialize_customer_service():
+    return kb_watcher.current().assistant
+
+def verify_signature(body, signature):
+    # 未設定 CHANNEL_SECRET 時不驗證簽章
+    if not LINE_CHANNEL_SECRET:
+        return True
+    digest = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode('utf-8'), signature or '')
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    if not verify_signature(request.get_data(), request.headers.get('X-Line-Signature')):
+        abort(400)
+
     body = request.json
     events = body.get('events', [])
 
+    # 帶有 X-Profile: 1 標頭的管理者請求或依 PROFILE_SAMPLE_RATE 取樣的請求進行效能分析
+    requested = request.headers.get('X-Profile') == '1' and is_admin_request()
+    with start_request_profile('webhook', requested=requested) as profiler:
+        handle_events(events)
+
+    if profiler.enabled:
+        record = profiler.save()
+        return jsonify({'status': 'ok', 'profile': record['folded']})
+    return jsonify({'status': 'ok'})
+
+def handle_events(events):
     for event in events:
         if event['type'] == 'message' and event['message']['type'] == 'text':
             user_message = event['message']['text']
@@ -48,16 +80,45 @@ def webhook():
             # 回覆用戶
             reply_message(reply_token, response)
 
-    return jsonify({'status': 'ok'})
-
 def handle_user_message(message):
     # 在這裡調用您的Streamlit應用的邏輯
     # 例如，將消息傳遞給客服助手
     # 這裡可以返回助手的回應
-    cs_assistant = initialize_customer_service()
-    assistant_response = cs_assistant.answer_question(message, debug_callback=None)
+    # 整個請求使用同一個知識庫快照，期間即使知識庫被替換也不受影響
+    snapshot = kb_watcher.current()
+    assistant_response = snapshot.assistant.answer_question(message, debug_callback=None)
     return assistant_response
 
+def is_admin_request():
+    # 未設定 ADMIN_TOKEN 時停用管理端點
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+
+@app.route('/admin/knowledge-base', methods=['GET'])
+def knowledge_base_status():
+    if not is_admin_request():
+        abort(403)
+    return jsonify({
+        'snapshot': kb_watcher.current().describe(),
+        'status': kb_watcher.status,
+        'answer_tiers': kb_watcher.current().assistant.get_tier_stats(),
+    })
+
+@app.route('/admin/knowledge-base/reload', methods=['POST'])
+def reload_knowledge_base():
+    if not is_admin_request():
+        abort(403)
+    # 在背景建立新版本，舊版本繼續服務直到替換完成
+    started = kb_watcher.reload(wait=False, force=request.args.get('force') == '1')
+    return jsonify({'reloading': started, 'snapshot': kb_watcher.current().describe()}), 202
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    if not is_admin_request():
+        abort(403)
+    return jsonify({'profiles': recent_profiles()})
+
 def reply_message(reply_token, message):
     headers = {
         'Content-Type': 'application/json',
@@ -75,4 +136,5 @@ def reply_message(reply_token, message):
         print(response.text)
 
 if __name__ == '__main__':
-    app.run(port=5000)
+    kb_watcher.start()
+    app.run(port=int(os.getenv("PORT", "5000")))
@@ -0,0 +1,147 @@
+"""
+LINE Webhook 的 ASGI 版本
+
+與 line.py 功能相同，但在事件迴圈上處理請求：webhook 收到事件後立即回應 LINE，
+問題在背景以 aanswer_question 非同步處理，單一行程即可同時處理大量對話，
+不需要每個請求佔用一個執行緒。
+
+啟動方式:
+    uvicorn line_asgi:app --port 5000
+"""
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import httpx
+from dotenv import load_dotenv
+from langchain_openai import ChatOpenAI
+from customer_service_ai import CustomerServiceAI
+from kb_watcher import KnowledgeBaseWatcher
+
+load_dotenv()
+
+# LINE Messaging API的設置
+LINE_CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESSTOKEN")
+LINE_CHANNEL_SECRET = os.getenv("CHANNEL_SECRET")
+LINE_API_URL = os.getenv("LINE_API_URL", 'https://api.line.me/v2/bot/message/reply')
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+QA_FILE = "customer_service_qa.json"
+# 每個問題的時間預算（秒），須在 LINE reply token 失效前回覆
+ANSWER_LATENCY_BUDGET = float(os.getenv("ANSWER_LATENCY_BUDGET", "20"))
+
+def initialize_llm():
+    return ChatOpenAI(model="gpt-4o")
+
+def build_customer_service(qa_data):
+    cs_assistant = CustomerServiceAI(initialize_llm())
+    cs_assistant.latency_budget = ANSWER_LATENCY_BUDGET
+    cs_assistant.load_qa_data(qa_data)
+    return cs_assistant
+
+# 知識庫檔案變更時在背景重建並替換，不需重啟服務
+kb_watcher = KnowledgeBaseWatcher(
+    QA_FILE, build_customer_service, poll_interval=float(os.getenv("KB_POLL_INTERVAL", "5"))
+)
+
+def verify_signature(body, signature):
+    # 未設定 CHANNEL_SECRET 時不驗證簽章
+    if not LINE_CHANNEL_SECRET:
+        return True
+    digest = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode('utf-8'), signature or '')
+
+@asynccontextmanager
+async def lifespan(app):
+    # 建立索引是同步的 CPU/網路工作，放到執行緒中避免阻塞事件迴圈
+    await asyncio.to_thread(kb_watcher.start)
+    app.state.http_client = httpx.AsyncClient(timeout=30)
+    try:
+        yield
+    finally:
+        kb_watcher.stop()
+        await app.state.http_client.aclose()
+
+async def webhook(request):
+    body = await request.body()
+    if not verify_signature(body, request.headers.get('X-Line-Signature')):
+        return PlainTextResponse('Invalid signature', status_code=400)
+
+    events = json.loads(body or b'{}').get('events', [])
+
+    # 先回應 LINE，再於背景處理事件
+    task = BackgroundTask(handle_events, request.app, events)
+    return JSONResponse({'status': 'ok'}, background=task)
+
+async def handle_events(app, events):
+    await asyncio.gather(*[
+        handle_event(app, event) for event in events
+        if event['type'] == 'message' and event['message']['type'] == 'text'
+    ])
+
+async def handle_event(app, event):
+    user_message = event['message']['text']
+    reply_token = event['replyToken']
+
+    # 整個請求使用同一個知識庫快照，期間即使知識庫被替換也不受影響
+    snapshot = kb_watcher.current()
+    response = await snapshot.assistant.aanswer_question(user_message, debug_callback=None)
+    await reply_message(app.state.http_client, reply_token, response)
+
+def is_admin_request(request):
+    # 未設定 ADMIN_TOKEN 時停用管理端點
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+
+async def knowledge_base_status(request):
+    if not is_admin_request(request):
+        return PlainTextResponse('Forbidden', status_code=403)
+    return JSONResponse({
+        'snapshot': kb_watcher.current().describe(),
+        'status': kb_watcher.status,
+        'answer_tiers': kb_watcher.current().assistant.get_tier_stats(),
+    })
+
+async def reload_knowledge_base(request):
+    if not is_admin_request(request):
+        return PlainTextResponse('Forbidden', status_code=403)
+    # 在背景建立新版本，舊版本繼續服務直到替換完成
+    started = kb_watcher.reload(wait=False, force=request.query_params.get('force') == '1')
+    return JSONResponse({'reloading': started, 'snapshot': kb_watcher.current().describe()}, status_code=202)
+
+async def reply_message(http_client, reply_token, message):
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}',
+    }
+    payload = {
+        'replyToken': reply_token,
+        'messages': [{'type': 'text', 'text': message}],
+    }
+    try:
+        response = await http_client.post(LINE_API_URL, headers=headers, json=payload)
+    except httpx.HTTPError as e:
+        print(f"Error sending message: {str(e)}")
+        return
+    if response.status_code == 200:
+        print("Message sent successfully!")
+    else:
+        print(f"Error sending message. Status code: {response.status_code}")
+        print(response.text)
+
+app = Starlette(routes=[
+    Route('/webhook', webhook, methods=['POST']),
+    Route('/admin/knowledge-base', knowledge_base_status, methods=['GET']),
+    Route('/admin/knowledge-base/reload', reload_knowledge_base, methods=['POST']),
+], lifespan=lifespan)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='127.0.0.1', port=int(os.getenv("PORT", "5000")))
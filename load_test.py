@@ -0,0 +1,480 @@
+"""
+LINE Webhook 壓力測試工具
+
+啟動本地的 LINE 與 OpenAI 模擬伺服器，並以指定的速率與併發數向 line.py 發送
+已簽章的 webhook 事件，最後統計吞吐量、端到端回覆延遲、重複回覆及遺失的事件。
+
+問題預設混合三種：知識庫原問題（直接匹配）、改寫過的問題（需要向量搜索及 LLM）
+及知識庫以外的問題（通用 LLM 回答），比例由 --reworded-ratio 與 --unmatched-ratio 設定，
+讓嵌入與 LLM 模擬伺服器的延遲及錯誤率反映在結果中。
+
+使用方式:
+    python load_test.py --events 500 --rate 20 --concurrency 16 --openai-latency 0.8
+
+若要測試已在執行中的服務，使用 --target 指定 webhook URL，並自行將該服務的
+LINE_API_URL 及 OPENAI_BASE_URL 指向模擬伺服器（啟動時會印出位址）。
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import math
+import os
+import random
+import re
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+
+class StubServer(ThreadingHTTPServer):
+    """可設定延遲與錯誤率的模擬伺服器"""
+
+    daemon_threads = True
+
+    def __init__(self, handler_class, latency=0.0, jitter=0.0, error_rate=0.0, port=0):
+        super().__init__(("127.0.0.1", port), handler_class)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def simulate(self):
+        """模擬網路延遲，並依錯誤率決定是否回傳錯誤"""
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        return random.random() < self.error_rate
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LineStubHandler(StubHandler):
+    """模擬 LINE Messaging API 的 reply 與 push 端點"""
+
+    def do_POST(self):
+        payload = self.read_json()
+        if self.server.simulate():
+            self.server.count("injected_errors")
+            self.send_json(500, {"message": "injected error"})
+            return
+
+        if self.path.endswith("/message/reply"):
+            self.server.count("reply")
+            self.server.record_reply(payload.get("replyToken"))
+        elif self.path.endswith("/message/push"):
+            self.server.count("push")
+            self.server.record_reply(payload.get("to"))
+        else:
+            self.send_json(404, {"message": "not found"})
+            return
+        self.send_json(200, {})
+
+
+class LineStubServer(StubServer):
+    def __init__(self, **kwargs):
+        super().__init__(LineStubHandler, **kwargs)
+        self.replies = {}
+
+    def record_reply(self, token):
+        now = time.perf_counter()
+        with self.lock:
+            self.replies.setdefault(token, []).append(now)
+
+
+class OpenAIStubHandler(StubHandler):
+    """模擬 OpenAI chat completions 與 embeddings 端點"""
+
+    dimensions = 256
+
+    def do_POST(self):
+        payload = self.read_json()
+        if self.server.simulate():
+            self.server.count("injected_errors")
+            self.send_json(500, {"error": {"message": "injected error", "type": "server_error"}})
+            return
+
+        if self.path.endswith("/chat/completions"):
+            self.server.count("chat")
+            self.send_json(200, self.chat_response(payload))
+        elif self.path.endswith("/embeddings"):
+            self.server.count("embeddings")
+            self.send_json(200, self.embeddings_response(payload))
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def chat_response(self, payload):
+        question = payload.get("messages", [{}])[-1].get("content", "")
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"這是模擬回答：{question[-50:]}"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": len(question), "completion_tokens": 20, "total_tokens": len(question) + 20},
+        }
+
+    def embeddings_response(self, payload):
+        inputs = payload.get("input", [])
+        # 輸入可能是字串、字串列表或 token 陣列
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+
+        data = []
+        for index, item in enumerate(inputs):
+            vector = self.fake_vector(json.dumps(item, ensure_ascii=False))
+            if payload.get("encoding_format") == "base64":
+                embedding = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+            else:
+                embedding = vector
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+
+        return {
+            "object": "list",
+            "data": data,
+            "model": payload.get("model", "stub"),
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        }
+
+    def fake_vector(self, text):
+        """依文字產生固定的單位向量，相同文字得到相同結果"""
+        rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+        vector = [rng.gauss(0, 1) for _ in range(self.dimensions)]
+        norm = sum(v * v for v in vector) ** 0.5 or 1.0
+        return [v / norm for v in vector]
+
+
+class OpenAIStubServer(StubServer):
+    def __init__(self, **kwargs):
+        super().__init__(OpenAIStubHandler, **kwargs)
+
+
+def sign_body(body, channel_secret):
+    """計算 LINE webhook 的 X-Line-Signature"""
+    digest = hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def build_event(text, reply_token):
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": f"U{uuid.uuid4().hex}"},
+        "replyToken": reply_token,
+        "message": {"id": uuid.uuid4().hex[:18], "type": "text", "text": text},
+    }
+
+
+def percentile(values, pct):
+    """最近排名法計算百分位數"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def load_questions(path):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    questions = [item["question"] if isinstance(item, dict) else str(item) for item in data]
+    return questions or ["如何聯繫客服？"]
+
+
+FILLER_PREFIXES = ["", "請問", "想問一下，", "不好意思，", "你好，"]
+FILLER_SUFFIXES = ["", "？", "呢？", "，謝謝"]
+UNMATCHED_QUESTIONS = [
+    "今天台北的天氣如何？",
+    "你們公司的地址在哪裡？",
+    "可以推薦一部好看的電影嗎？",
+    "我的訂單什麼時候會到？",
+    "你們有徵人嗎？",
+    "手機一直發燙該怎麼辦？",
+    "可以幫我翻譯一段英文嗎？",
+    "週末有什麼活動推薦？",
+]
+
+
+def reword_question(question, kb_questions, attempts=5):
+    """
+    將知識庫問題改寫成不會被直接匹配命中的問法（前後段對調並加上口語前後綴）
+
+    返回:
+    str or None: 改寫後的問題，無法改寫（問題太短或仍與知識庫問題互為子字串）時返回 None
+    """
+    core = re.sub(r"[？?。！!：:\s]+$", "", question.strip())
+    if len(core) < 4:
+        return None
+    for _ in range(attempts):
+        cut = random.randint(1, len(core) - 1)
+        candidate = f"{random.choice(FILLER_PREFIXES)}{core[cut:]}，{core[:cut]}{random.choice(FILLER_SUFFIXES)}"
+        lowered = candidate.lower()
+        if not any(q.lower() in lowered or lowered in q.lower() for q in kb_questions):
+            return candidate
+    return None
+
+
+def unmatched_question():
+    # 加上編號，避免重複的問題命中嵌入快取
+    return f"{random.choice(UNMATCHED_QUESTIONS)}（#{random.randint(1000, 99999)}）"
+
+
+def pick_question(kb_questions, reworded_ratio, unmatched_ratio):
+    """依比例選出 (問題, 類型)，類型為 exact、reworded 或 unmatched"""
+    roll = random.random()
+    if roll < unmatched_ratio:
+        return unmatched_question(), "unmatched"
+    if roll < unmatched_ratio + reworded_ratio:
+        reworded = reword_question(random.choice(kb_questions), kb_questions)
+        if reworded:
+            return reworded, "reworded"
+        return unmatched_question(), "unmatched"
+    return random.choice(kb_questions), "exact"
+
+
+def wait_for_port(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return True
+        except urllib.error.HTTPError:
+            # 伺服器已能回應（例如 405），代表已啟動
+            return True
+        except Exception:
+            time.sleep(0.2)
+    return False
+
+
+def start_app(app_script, port, line_server, openai_server, channel_secret):
+    """以子行程啟動 webhook 服務，並將外部 API 指向模擬伺服器"""
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "CHANNEL_ACCESSTOKEN": "stub-access-token",
+        "CHANNEL_SECRET": channel_secret,
+        "LINE_API_URL": f"{line_server.base_url}/v2/bot/message/reply",
+        "OPENAI_API_KEY": "stub-api-key",
+        "OPENAI_BASE_URL": f"{openai_server.base_url}/v1",
+        "OPENAI_API_BASE": f"{openai_server.base_url}/v1",
+    })
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), app_script)
+    return subprocess.Popen([sys.executable, script], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_load_test(target_url, questions, events, rate, concurrency, channel_secret, line_server, drain_timeout,
+                  reworded_ratio=0.4, unmatched_ratio=0.2):
+    """
+    發送事件並收集結果
+
+    延遲從事件排定的發送時間起算，而不是工作執行緒實際送出的時間，
+    因此併發上限不足造成的排隊等待也會計入延遲（避免 coordinated omission）；排隊時間另外以 dispatch_lag 報告。
+    """
+    sent = {}
+    dispatched = {}
+    kinds = {}
+    webhook_errors = []
+    lock = threading.Lock()
+
+    def send(scheduled):
+        reply_token = uuid.uuid4().hex
+        question, kind = pick_question(questions, reworded_ratio, unmatched_ratio)
+        body = json.dumps({
+            "destination": "stub",
+            "events": [build_event(question, reply_token)],
+        }, ensure_ascii=False).encode("utf-8")
+        http_request = urllib.request.Request(target_url, data=body, method="POST", headers={
+            "Content-Type": "application/json",
+            "X-Line-Signature": sign_body(body, channel_secret),
+        })
+        with lock:
+            sent[reply_token] = scheduled
+            dispatched[reply_token] = time.perf_counter()
+            kinds[reply_token] = kind
+        try:
+            with urllib.request.urlopen(http_request, timeout=120) as response:
+                response.read()
+        except Exception as e:
+            with lock:
+                webhook_errors.append(str(e))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index in range(events):
+            # 依照目標速率排程發送時間
+            scheduled = started + index / rate if rate > 0 else started
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, scheduled)
+
+    # 等待尚未送達的回覆
+    deadline = time.perf_counter() + drain_timeout
+    while time.perf_counter() < deadline:
+        with line_server.lock:
+            if all(token in line_server.replies for token in sent):
+                break
+        time.sleep(0.1)
+
+    with line_server.lock:
+        replies = {token: list(times) for token, times in line_server.replies.items()}
+
+    latencies = [replies[token][0] - start for token, start in sent.items() if token in replies]
+    latency_by_kind = {}
+    for kind in ("exact", "reworded", "unmatched"):
+        kind_latencies = [replies[token][0] - start for token, start in sent.items()
+                          if kinds[token] == kind and token in replies]
+        latency_by_kind[kind] = {
+            "events": sum(1 for token in sent if kinds[token] == kind),
+            "replies": len(kind_latencies),
+            "p50": percentile(kind_latencies, 50),
+            "p95": percentile(kind_latencies, 95),
+        }
+    dispatch_times = sorted(dispatched.values())
+    dispatch_lags = [dispatched[token] - scheduled for token, scheduled in sent.items()]
+    last_reply = max((times[0] for token, times in replies.items() if token in sent), default=started)
+    elapsed = max(last_reply - started, 1e-9)
+
+    return {
+        "events_sent": len(sent),
+        # 實際送出的速率（第一個到最後一個事件送出之間）；併發上限不足時會低於 --rate
+        "send_rate": ((len(dispatch_times) - 1) / max(dispatch_times[-1] - dispatch_times[0], 1e-9)
+                      if len(dispatch_times) > 1 else None),
+        "dispatch_lag": {f"p{p}": percentile(dispatch_lags, p) for p in (50, 99)},
+        "dispatch_lag_max": max(dispatch_lags) if dispatch_lags else None,
+        "webhook_errors": len(webhook_errors),
+        "replies": len(latencies),
+        "duplicate_replies": sum(len(times) - 1 for token, times in replies.items() if token in sent),
+        "dropped_events": sum(1 for token in sent if token not in replies),
+        "throughput": len(latencies) / elapsed,
+        "latency": {f"p{p}": percentile(latencies, p) for p in (50, 90, 95, 99)},
+        "latency_max": max(latencies) if latencies else None,
+        "latency_by_kind": latency_by_kind,
+    }
+
+
+def print_report(report, line_server, openai_server):
+    def fmt(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.0f} ms"
+
+    print("\n===== 壓力測試結果 =====")
+    send_rate = "-" if report["send_rate"] is None else f"{report['send_rate']:.1f}/s"
+    print(f"送出事件: {report['events_sent']} (實際送出速率 {send_rate})")
+    print("排隊延遲（排定時間到實際送出）: "
+          + ", ".join(f"{name}={fmt(value)}" for name, value in report["dispatch_lag"].items())
+          + f", max={fmt(report['dispatch_lag_max'])}")
+    print(f"Webhook 錯誤: {report['webhook_errors']}")
+    print(f"成功回覆: {report['replies']}")
+    print(f"吞吐量: {report['throughput']:.2f} 回覆/秒")
+    print("回覆延遲（從排定時間起算）: " + ", ".join(f"{name}={fmt(value)}" for name, value in report["latency"].items())
+          + f", max={fmt(report['latency_max'])}")
+    for kind, stats in report["latency_by_kind"].items():
+        print(f"  {kind}: {stats['replies']}/{stats['events']} 回覆, p50={fmt(stats['p50'])}, p95={fmt(stats['p95'])}")
+    print(f"重複回覆: {report['duplicate_replies']}")
+    print(f"遺失事件: {report['dropped_events']}")
+    print(f"LINE 模擬伺服器: {line_server.counters}")
+    print(f"OpenAI 模擬伺服器: {openai_server.counters}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LINE webhook 壓力測試")
+    parser.add_argument("--events", type=int, default=200, help="發送的事件總數")
+    parser.add_argument("--rate", type=float, default=10.0, help="每秒發送的事件數，0 表示不限速")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時進行中的 webhook 請求上限")
+    parser.add_argument("--target", help="已在執行中的 webhook URL，未指定則自動啟動 line.py")
+    parser.add_argument("--app", default="line.py", choices=["line.py", "line_asgi.py"],
+                        help="自動啟動的 webhook 服務（Flask 或 ASGI 版本）")
+    parser.add_argument("--app-port", type=int, default=5055, help="自動啟動 line.py 時使用的埠號")
+    parser.add_argument("--channel-secret", default="stub-channel-secret", help="簽章用的 channel secret")
+    parser.add_argument("--questions", default="customer_service_qa.json", help="問題來源 JSON 檔案")
+    parser.add_argument("--reworded-ratio", type=float, default=0.4,
+                        help="改寫過的知識庫問題比例（不會被直接匹配命中，需經過向量搜索及 LLM）")
+    parser.add_argument("--unmatched-ratio", type=float, default=0.2, help="知識庫以外問題的比例")
+    parser.add_argument("--line-latency", type=float, default=0.05)
+    parser.add_argument("--line-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--openai-jitter", type=float, default=0.2)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="發送結束後等待回覆的秒數")
+    parser.add_argument("--report", help="將結果另存為 JSON 檔案")
+    args = parser.parse_args()
+    if args.reworded_ratio < 0 or args.unmatched_ratio < 0 or args.reworded_ratio + args.unmatched_ratio > 1:
+        parser.error("--reworded-ratio 與 --unmatched-ratio 須為非負數且總和不超過 1")
+
+    line_server = LineStubServer(latency=args.line_latency, error_rate=args.line_error_rate).start()
+    openai_server = OpenAIStubServer(latency=args.openai_latency, jitter=args.openai_jitter,
+                                     error_rate=args.openai_error_rate).start()
+    print(f"LINE 模擬伺服器: {line_server.base_url}")
+    print(f"OpenAI 模擬伺服器: {openai_server.base_url}/v1")
+
+    app_process = None
+    target_url = args.target
+    if not target_url:
+        app_process = start_app(args.app, args.app_port, line_server, openai_server, args.channel_secret)
+        target_url = f"http://127.0.0.1:{args.app_port}/webhook"
+        if not wait_for_port(target_url, timeout=60):
+            app_process.terminate()
+            sys.exit(f"{args.app} 未能在時間內啟動")
+
+    try:
+        questions = load_questions(args.questions) if os.path.exists(args.questions) else ["如何聯繫客服？"]
+        report = run_load_test(target_url, questions, args.events, args.rate, args.concurrency,
+                               args.channel_secret, line_server, args.drain_timeout,
+                               args.reworded_ratio, args.unmatched_ratio)
+        print_report(report, line_server, openai_server)
+
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=4)
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+            app_process.wait(timeout=10)
+        line_server.shutdown()
+        openai_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
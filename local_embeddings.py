@@ -0,0 +1,40 @@
+from langchain_core.embeddings import Embeddings
+from embedding_cache import normalize_text
+import hashlib
+import re
+
+_IGNORED_CHARS = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+class CharNgramEmbeddings(Embeddings):
+    """
+    不需呼叫 API 的本地嵌入模型
+
+    將正規化後文字的字元 n-gram 雜湊到固定維度並做 L2 正規化，相當於字面相似度。
+    用於離線評估與測試，或作為沒有網路時的備用檢索方式。
+    """
+
+    def __init__(self, dimensions=512, ngram_range=(1, 3)):
+        self.dimensions = dimensions
+        self.ngram_range = ngram_range
+        self.model = f"local-char-ngram-{dimensions}"
+
+    def _bucket(self, gram):
+        digest = hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        # 以雜湊的一個位元決定正負號，減少碰撞造成的偏差
+        return value % self.dimensions, 1.0 if value >> 63 else -1.0
+
+    def embed_query(self, text):
+        text = _IGNORED_CHARS.sub("", normalize_text(text))
+        vector = [0.0] * self.dimensions
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            for i in range(len(text) - n + 1):
+                bucket, sign = self._bucket(text[i:i + n])
+                vector[bucket] += sign
+
+        norm = sum(v * v for v in vector) ** 0.5
+        return [v / norm for v in vector] if norm else vector
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
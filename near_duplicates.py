@@ -0,0 +1,272 @@
+"""
+知識庫近似重複偵測與壓縮
+
+以正規化後的字元 shingle 計算 MinHash，透過 LSH 找出候選配對，再確認問題與答案的
+Jaccard 相似度都達到門檻（可選擇再加上嵌入向量距離），將近似重複的問答對分群。
+問題與答案分開比較，避免答案套用相同範本但問題不同（例如不同活動）的問答對被合併。
+
+使用方式:
+    python near_duplicates.py report customer_service_qa.json
+    python near_duplicates.py compact customer_service_qa.json --threshold 0.8 --rebuild
+"""
+from embedding_cache import normalize_text
+import argparse
+import hashlib
+import json
+import re
+import numpy as np
+
+_MAX_HASH = (1 << 32) - 1
+_IGNORED_CHARS = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def shingles(text, k=3):
+    """將文字正規化並去除空白與標點後，切成長度 k 的字元片段"""
+    text = _IGNORED_CHARS.sub("", normalize_text(text))
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def jaccard(set1, set2):
+    if not set1 and not set2:
+        return 1.0
+    return len(set1 & set2) / len(set1 | set2)
+
+
+def qa_shingles(qa):
+    """問答對的問題與答案 shingle 集合"""
+    return shingles(qa["question"]), shingles(qa["answer"])
+
+
+def qa_similarity(shingles1, shingles2):
+    """問答對的相似度：問題與答案 Jaccard 相似度中較低者"""
+    return min(jaccard(shingles1[0], shingles2[0]), jaccard(shingles1[1], shingles2[1]))
+
+
+class MinHasher:
+    """
+    以多組 multiply-shift 雜湊函數模擬排列，計算 shingle 集合的 MinHash 簽章
+
+    所有雜湊函數以 numpy 一次計算（uint64 乘法溢位即為 mod 2^64），取高 32 位元作為雜湊值。
+    """
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        # multiply-shift 的乘數須為奇數
+        self.a = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64)
+
+    def signature(self, shingle_set):
+        if not shingle_set:
+            return (_MAX_HASH,) * self.num_perm
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingle_set),
+            dtype=np.uint64, count=len(shingle_set)
+        )
+        values = (self.a * hashes + self.b) >> np.uint64(32)
+        return tuple(values.min(axis=1).tolist())
+
+
+class NearDuplicateIndex:
+    """
+    問答對的 MinHash/LSH 近似重複索引
+
+    參數:
+    threshold (float): 判定為近似重複的相似度下限（問題與答案都須達到）
+    num_perm (int): MinHash 簽章長度
+    bands (int): LSH 分段數，num_perm 需能被整除
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self._buckets = {}
+        self._shingles = {}
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield (band, signature[band * self.rows:(band + 1) * self.rows])
+
+    def _signature(self, qa_shingle_sets):
+        # 問題與答案的 shingle 加上前綴後合併計算簽章，用於找出候選配對
+        question_shingles, answer_shingles = qa_shingle_sets
+        combined = {"q" + s for s in question_shingles} | {"a" + s for s in answer_shingles}
+        return self.hasher.signature(combined)
+
+    def add(self, key, qa):
+        qa_shingle_sets = qa_shingles(qa)
+        self._shingles[key] = qa_shingle_sets
+        for band_key in self._band_keys(self._signature(qa_shingle_sets)):
+            self._buckets.setdefault(band_key, []).append(key)
+
+    def query(self, qa):
+        """返回與問答對近似重複的 (鍵, 相似度) 列表，依相似度由高到低排序"""
+        qa_shingle_sets = qa_shingles(qa)
+        candidates = set()
+        for band_key in self._band_keys(self._signature(qa_shingle_sets)):
+            candidates.update(self._buckets.get(band_key, []))
+
+        matches = []
+        for key in candidates:
+            similarity = qa_similarity(qa_shingle_sets, self._shingles[key])
+            if similarity >= self.threshold:
+                matches.append((key, similarity))
+        return sorted(matches, key=lambda x: -x[1])
+
+
+def _cosine(v1, v2):
+    dot = sum(a * b for a, b in zip(v1, v2))
+    norm = (sum(a * a for a in v1) ** 0.5) * (sum(b * b for b in v2) ** 0.5)
+    return dot / norm if norm else 0.0
+
+
+def find_duplicate_clusters(qa_data, threshold=0.8, embeddings=None, embedding_threshold=0.95):
+    """
+    將近似重複的問答對分群
+
+    參數:
+    qa_data (list): Q&A 資料
+    threshold (float): 問題與答案的 Jaccard 相似度下限
+    embeddings: 可選的 LangChain 嵌入模型，提供時候選配對的問題嵌入餘弦相似度也須達到 embedding_threshold
+    embedding_threshold (float): 嵌入餘弦相似度下限
+
+    返回:
+    list: 每個群組為問答對索引的列表（只包含兩個以上的群組，依檔案順序排列），
+          最後一筆為保留的問答對，其他成員都與它直接近似重複
+    """
+    index = NearDuplicateIndex(threshold=threshold)
+    pairs = []
+    for i, qa in enumerate(qa_data):
+        pairs.extend((j, i) for j, _ in index.query(qa))
+        index.add(i, qa)
+
+    if embeddings is not None and pairs:
+        vectors = embeddings.embed_documents([qa["question"] for qa in qa_data])
+        pairs = [(i, j) for i, j in pairs if _cosine(vectors[i], vectors[j]) >= embedding_threshold]
+
+    neighbors = {}
+    for i, j in pairs:
+        neighbors.setdefault(j, set()).add(i)
+
+    # 不做遞移合併（A~B、B~C 不代表 A~C）：由最新的一筆開始，每個尚未分群的問答對作為保留的一筆，
+    # 只有與它直接近似重複且較早的問答對併入，確保被合併掉的每一筆都與保留的一筆相似
+    assigned = set()
+    clusters = []
+    for i in reversed(range(len(qa_data))):
+        if i in assigned:
+            continue
+        members = sorted(j for j in neighbors.get(i, ()) if j not in assigned)
+        if members:
+            assigned.update(members)
+            clusters.append(members + [i])
+        assigned.add(i)
+    return sorted(clusters)
+
+
+def merge_entries(entries):
+    """
+    合併近似重複的問答對
+
+    保留最後（最新）的一筆，其他筆不同的問題及原有的 aliases 成為別名。
+    """
+    merged = dict(entries[-1])
+    seen = {normalize_text(merged["question"])}
+    aliases = []
+    for qa in entries:
+        for text in [qa["question"]] + list(qa.get("aliases", [])):
+            key = normalize_text(text)
+            if key not in seen:
+                seen.add(key)
+                aliases.append(text)
+    if aliases:
+        merged["aliases"] = aliases
+    return merged
+
+
+def count_index_documents(qa_data):
+    """向量索引的文檔數量（每個問答對的問題、問答及別名各一份）"""
+    return sum(2 + len(qa.get("aliases", [])) for qa in qa_data)
+
+
+def compact_qa_data(qa_data, threshold=0.8, embeddings=None, embedding_threshold=0.95):
+    """
+    合併近似重複的問答對
+
+    返回:
+    tuple: (壓縮後的 Q&A 資料, 群組列表)
+    """
+    clusters = find_duplicate_clusters(qa_data, threshold, embeddings, embedding_threshold)
+    # 合併後的問答對放在群組中最後一筆的位置
+    replacements = {members[-1]: merge_entries([qa_data[i] for i in members]) for members in clusters}
+    dropped = {i for members in clusters for i in members[:-1]}
+
+    compacted = [replacements.get(i, qa) for i, qa in enumerate(qa_data) if i not in dropped]
+    return compacted, clusters
+
+
+def _print_clusters(qa_data, clusters):
+    for n, members in enumerate(clusters, 1):
+        print(f"\n群組 {n}（{len(members)} 筆）:")
+        for i in members:
+            print(f"  [{i}] {qa_data[i]['question']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="知識庫近似重複偵測與壓縮")
+    parser.add_argument("command", choices=["report", "compact"], help="report: 列出近似重複群組；compact: 合併並寫回")
+    parser.add_argument("qa_file", nargs="?", default="customer_service_qa.json", help="知識庫 JSON 檔案")
+    parser.add_argument("--threshold", type=float, default=0.8, help="問題與答案的 Jaccard 相似度下限")
+    parser.add_argument("--embedding-check", action="store_true", help="另外以 OpenAI 嵌入向量確認相似度")
+    parser.add_argument("--embedding-threshold", type=float, default=0.95, help="嵌入餘弦相似度下限")
+    parser.add_argument("--output", help="輸出檔案，未指定則覆寫原檔")
+    parser.add_argument("--dry-run", action="store_true", help="只顯示結果，不寫入檔案")
+    parser.add_argument("--rebuild", action="store_true", help="壓縮後重建向量索引並比較大小")
+    args = parser.parse_args()
+
+    with open(args.qa_file, "r", encoding="utf-8") as f:
+        qa_data = json.load(f)
+
+    embeddings = None
+    if args.embedding_check or args.rebuild:
+        from dotenv import load_dotenv
+        load_dotenv()
+    if args.embedding_check:
+        from langchain_openai import OpenAIEmbeddings
+        from embedding_cache import CachedEmbeddings
+        embeddings = CachedEmbeddings(OpenAIEmbeddings())
+
+    compacted, clusters = compact_qa_data(qa_data, args.threshold, embeddings, args.embedding_threshold)
+    _print_clusters(qa_data, clusters)
+
+    docs_before = count_index_documents(qa_data)
+    docs_after = count_index_documents(compacted)
+    shrink = (1 - docs_after / docs_before) * 100 if docs_before else 0.0
+    print(f"\n找到 {len(clusters)} 個近似重複群組")
+    print(f"問答對: {len(qa_data)} -> {len(compacted)}")
+    print(f"索引文檔: {docs_before} -> {docs_after}（減少 {shrink:.1f}%）")
+
+    if args.command != "compact" or args.dry_run:
+        return
+
+    output = args.output or args.qa_file
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(compacted, f, ensure_ascii=False, indent=4)
+    print(f"已寫入 {output}")
+
+    if args.rebuild:
+        from langchain_openai import ChatOpenAI
+        from customer_service_ai import CustomerServiceAI
+
+        cs_assistant = CustomerServiceAI(ChatOpenAI(model="gpt-4o"))
+        cs_assistant.load_qa_data(compacted)
+        if cs_assistant.vector_index_built:
+            index = cs_assistant.vector_store.index
+            print(f"新索引: {index.ntotal} 個向量，約 {index.ntotal * index.d * 4 / 1024:.1f} KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+離線產生知識庫問題的改寫問法
+
+為每個問答對產生數個意思相同的問法，存到該問答對的 "aliases" 欄位。
+CustomerServiceAI 會將 aliases 加入直接匹配、關鍵詞匹配及向量索引，
+換句話說的問題也能直接命中知識庫，不需要線上呼叫 LLM。
+
+使用方式:
+    python paraphrase_expansion.py customer_service_qa.json --count 5
+    python paraphrase_expansion.py customer_service_qa.json --stub --output /tmp/qa_with_aliases.json
+"""
+from embedding_cache import normalize_text
+import argparse
+import json
+import re
+import traceback
+
+
+class LLMParaphraser:
+    """使用 LLM 產生改寫問法"""
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    def generate(self, question, answer, count):
+        from langchain_core.prompts import PromptTemplate
+        from langchain_core.output_parsers import StrOutputParser
+
+        template = """
+        你是一個客服知識庫的編輯。請為以下客服問題寫出 {count} 種不同的問法，
+        模擬真實用戶可能的提問方式（口語、簡短、錯字較少的變化皆可），但意思必須與原問題相同，
+        且都能用同一個答案回答。
+
+        原問題: {question}
+
+        參考答案: {answer}
+
+        請只輸出 JSON 字串陣列，例如 ["問法一", "問法二"]:
+        """
+
+        prompt = PromptTemplate(
+            template=template,
+            input_variables=["count", "question", "answer"]
+        )
+
+        chain = prompt | self.llm | StrOutputParser()
+        response = chain.invoke({"count": count, "question": question, "answer": answer[:500]})
+        return parse_paraphrases(response)[:count]
+
+
+class StubParaphraser:
+    """不呼叫 LLM 的規則式改寫，用於測試或離線環境"""
+
+    prefixes = ["請問", "想問一下", "我想知道", "請教一下"]
+    suffixes = ["", "？", "呢？", "嗎？"]
+
+    def generate(self, question, answer, count):
+        core = re.sub(r"^(請問|想問一下|我想知道|請教一下)[，,\s]*", "", question.strip())
+        # 句尾的語氣詞與標點一起去掉，避免加上後綴後變成「呢呢？」
+        core = re.sub(r"[呢嗎？?。！!]+$", "", core)
+
+        variants = [core]
+        for prefix in self.prefixes:
+            for suffix in self.suffixes:
+                variants.append(f"{prefix}{core}{suffix}")
+        return variants[:count]
+
+
+def parse_paraphrases(text):
+    """從 LLM 輸出中解析問法列表，JSON 解析失敗時改為逐行解析"""
+    match = re.search(r"\[.*\]", text, re.S)
+    if match:
+        try:
+            items = json.loads(match.group(0))
+            return [str(item).strip() for item in items if str(item).strip()]
+        except ValueError:
+            pass
+
+    lines = [re.sub(r"^\s*(?:[-*•]|\d+[.、)])\s*", "", line).strip() for line in text.splitlines()]
+    return [line.strip('"「」') for line in lines if line]
+
+
+def expand_qa_data(qa_data, paraphraser, count=5, refresh=False):
+    """
+    為 Q&A 資料加入改寫問法
+
+    參數:
+    qa_data (list): Q&A 資料，會直接修改
+    paraphraser: 具有 generate(question, answer, count) 方法的物件
+    count (int): 每個問題產生的問法數量
+    refresh (bool): 是否重新產生已有 aliases 的問題
+
+    返回:
+    dict: 統計資料
+    """
+    # 與任何原始問題相同的問法會造成歧義，不加入
+    questions = [normalize_text(qa["question"]) for qa in qa_data]
+    taken = set(questions)
+    stats = {"questions": 0, "aliases_added": 0, "skipped": 0, "errors": 0, "ambiguous": 0}
+
+    for index, qa in enumerate(qa_data):
+        if qa.get("aliases") and not refresh:
+            stats["skipped"] += 1
+            continue
+
+        try:
+            candidates = paraphraser.generate(qa["question"], qa["answer"], count)
+        except Exception:
+            print(f"產生改寫問法時出錯（{qa['question']}）: {traceback.format_exc()}")
+            stats["errors"] += 1
+            continue
+
+        aliases = []
+        for candidate in candidates:
+            key = normalize_text(candidate)
+            if not key or key in taken:
+                continue
+            # 包含在其他問題中的短問法（例如「怎麼儲值」）同樣符合多個問題，不加入
+            if any(key in other for other_index, other in enumerate(questions) if other_index != index):
+                stats["ambiguous"] += 1
+                continue
+            taken.add(key)
+            aliases.append(candidate)
+
+        qa["aliases"] = aliases
+        stats["questions"] += 1
+        stats["aliases_added"] += len(aliases)
+        print(f"{qa['question']} -> {len(aliases)} 個改寫問法")
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="離線產生知識庫問題的改寫問法")
+    parser.add_argument("qa_file", nargs="?", default="customer_service_qa.json", help="知識庫 JSON 檔案")
+    parser.add_argument("--output", help="輸出檔案，未指定則覆寫原檔")
+    parser.add_argument("--count", type=int, default=5, help="每個問題產生的問法數量")
+    parser.add_argument("--model", default="gpt-4o", help="產生問法使用的模型")
+    parser.add_argument("--stub", action="store_true", help="使用規則式改寫，不呼叫 LLM")
+    parser.add_argument("--refresh", action="store_true", help="重新產生已有改寫問法的問題")
+    args = parser.parse_args()
+
+    with open(args.qa_file, "r", encoding="utf-8") as f:
+        qa_data = json.load(f)
+
+    if args.stub:
+        paraphraser = StubParaphraser()
+    else:
+        from dotenv import load_dotenv
+        from langchain_openai import ChatOpenAI
+
+        load_dotenv()
+        paraphraser = LLMParaphraser(ChatOpenAI(model=args.model, temperature=0.8))
+
+    stats = expand_qa_data(qa_data, paraphraser, count=args.count, refresh=args.refresh)
+
+    with open(args.output or args.qa_file, "w", encoding="utf-8") as f:
+        json.dump(qa_data, f, ensure_ascii=False, indent=4)
+
+    print(f"完成: 處理 {stats['questions']} 個問題，新增 {stats['aliases_added']} 個改寫問法，"
+          f"略過 {stats['skipped']} 個，捨棄 {stats['ambiguous']} 個與其他問題重疊的問法，失敗 {stats['errors']} 個")
+
+
+if __name__ == "__main__":
+    main()
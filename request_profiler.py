@@ -0,0 +1,255 @@
+"""
+單一請求的取樣式效能分析
+
+啟用時以背景執行緒定期讀取處理請求的執行緒（及其在階段執行緒池中執行的工作）的呼叫堆疊，
+輸出 collapsed-stack 格式（可用 flamegraph.pl 或 https://www.speedscope.app 繪製火焰圖）
+及依函數統計的摘要。未啟用時不會啟動取樣執行緒，只多一次判斷。
+
+啟用方式:
+- 呼叫時指定，例如 answer_question(..., profile=True) 或 LINE webhook 的 X-Profile: 1 標頭
+- 環境變數 PROFILE_SAMPLE_RATE=N：每 N 個請求取樣一個（預設 0，不取樣）
+"""
+from collections import Counter, deque
+from contextlib import contextmanager
+import itertools
+import os
+import sys
+import threading
+import time
+import traceback
+
+PROFILE_SAMPLE_RATE = int(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_OUTPUT_DIR = os.environ.get("PROFILE_OUTPUT_DIR", ".profiles")
+# 取樣間隔（秒）
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))
+
+_local = threading.local()
+_request_counter = itertools.count(1)
+_recent_profiles = deque(maxlen=20)
+
+
+def current_profile():
+    """目前執行緒正在進行的效能分析，沒有時返回 None"""
+    return getattr(_local, "profile", None)
+
+
+class _NoProfile:
+    """不進行分析的請求"""
+
+    enabled = False
+
+    def __init__(self, outermost):
+        self.outermost = outermost
+
+    def __enter__(self):
+        # 最外層的請求決定不分析時，期間內層的呼叫也不再取樣
+        if self.outermost:
+            _local.decided = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.outermost:
+            _local.decided = False
+        return False
+
+
+def start_request_profile(name, requested=False):
+    """
+    決定此請求是否進行效能分析
+
+    每個請求只在最外層（例如 webhook）決定一次；內層的呼叫（例如 webhook 中的 answer_question）
+    不會另外分析或取樣，避免重複記錄及改變取樣比例。
+
+    參數:
+    name (str): 請求名稱，用於檔名與摘要
+    requested (bool): 是否明確要求分析
+
+    返回:
+    以 with 使用的物件，enabled 為 True 時是 RequestProfile，結束後呼叫 save() 寫入結果
+    """
+    if current_profile() is not None or getattr(_local, "decided", False):
+        return _NoProfile(outermost=False)
+    if not requested:
+        if PROFILE_SAMPLE_RATE <= 0 or next(_request_counter) % PROFILE_SAMPLE_RATE:
+            return _NoProfile(outermost=True)
+    return RequestProfile(name, interval=PROFILE_INTERVAL)
+
+
+def recent_profiles():
+    """最近完成的效能分析記錄，由新到舊"""
+    return list(reversed(_recent_profiles))
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    # collapsed-stack 以分號分隔堆疊，名稱中不能出現分號
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+def _stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+class RequestProfile:
+    """
+    單一請求的取樣式效能分析
+
+    參數:
+    name (str): 請求名稱
+    interval (float): 取樣間隔（秒）
+    """
+
+    enabled = True
+
+    def __init__(self, name, interval=0.005):
+        self.name = name
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self._threads = {}
+        self._waiting = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._started = None
+
+    def __enter__(self):
+        _local.profile = self
+        self._add_thread(threading.get_ident(), f"request:{self.name}")
+        self._started = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self._started
+        _local.profile = None
+        return False
+
+    def _add_thread(self, ident, label):
+        with self._lock:
+            self._threads[ident] = label
+
+    def _remove_thread(self, ident):
+        with self._lock:
+            self._threads.pop(ident, None)
+
+    def wrap(self, func, label):
+        """包裝在其他執行緒（例如階段執行緒池）中執行的工作，執行期間一併取樣"""
+        def run(*args, **kwargs):
+            ident = threading.get_ident()
+            self._add_thread(ident, label)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._remove_thread(ident)
+        return run
+
+    @contextmanager
+    def waiting(self):
+        """
+        目前執行緒等待被包裝的工作完成期間不取樣
+
+        處理請求的執行緒等待階段執行緒池的結果時只是閒置，若一併取樣，
+        等待函數（例如 threading 的 wait）會與實際執行的工作重複計入，扭曲各函數的比例。
+        """
+        ident = threading.get_ident()
+        with self._lock:
+            self._waiting.add(ident)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._waiting.discard(ident)
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = [(ident, label) for ident, label in self._threads.items() if ident not in self._waiting]
+            for ident, label in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[(label, *_stack(frame))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """collapsed-stack 格式，每行為「以分號連接的堆疊 次數」"""
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in sorted(self.stacks.items())) + "\n"
+
+    def top_functions(self, limit=20):
+        """
+        依函數統計取樣次數
+
+        同一次取樣中多個執行緒的堆疊分別計入，因此次數加總可能超過取樣次數。
+
+        返回:
+        tuple: (依自身時間排序的 [(函數, 次數)], 依包含子呼叫的累計時間排序的 [(函數, 次數)])
+        """
+        self_counts = Counter()
+        cumulative_counts = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack[1:]
+            if not frames:
+                continue
+            self_counts[frames[-1]] += count
+            for label in set(frames):
+                cumulative_counts[label] += count
+        return self_counts.most_common(limit), cumulative_counts.most_common(limit)
+
+    def summary(self, limit=20):
+        """文字摘要，百分比為函數出現在取樣中的次數佔取樣次數的比例"""
+        total = self.samples or 1
+        self_top, cumulative_top = self.top_functions(limit)
+        lines = [
+            f"請求: {self.name}",
+            f"耗時: {self.duration:.3f} 秒，取樣 {self.samples} 次（間隔 {self.interval * 1000:.1f} ms），堆疊樣本 {sum(self.stacks.values())} 個",
+            "",
+            "自身時間最多的函數:",
+        ]
+        lines += [f"  {count / total * 100:6.1f}%  {count:6d}  {label}" for label, count in self_top]
+        lines += ["", "累計時間最多的函數（含子呼叫）:"]
+        lines += [f"  {count / total * 100:6.1f}%  {count:6d}  {label}" for label, count in cumulative_top]
+        return "\n".join(lines) + "\n"
+
+    def save(self, output_dir=None):
+        """
+        寫入 collapsed-stack 檔案及摘要
+
+        返回:
+        dict: 分析記錄（name、duration、samples、folded、summary_file、summary），寫入失敗時檔案路徑為 None
+        """
+        output_dir = output_dir or PROFILE_OUTPUT_DIR
+        summary = self.summary()
+        record = {
+            "name": self.name,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "duration": round(self.duration, 3),
+            "samples": self.samples,
+            "folded": None,
+            "summary_file": None,
+            "summary": summary,
+        }
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            base = os.path.join(output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.name}-{id(self):x}")
+            with open(base + ".folded", "w", encoding="utf-8") as f:
+                f.write(self.collapsed())
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write(summary)
+            record["folded"] = base + ".folded"
+            record["summary_file"] = base + ".txt"
+            print(f"已寫入效能分析: {record['folded']}")
+        except Exception:
+            print(f"寫入效能分析時出錯: {traceback.format_exc()}")
+
+        _recent_profiles.append(record)
+        return record
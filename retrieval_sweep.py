@@ -0,0 +1,421 @@
+"""
+檢索參數離線評估
+
+以知識庫的問答對及保留的改寫問法（aliases，或 --paraphrases 指定的檔案）作為標準答案，
+改寫問法不加入索引，用來模擬用戶的換句話說。掃描 search_k、上下文問答對數量、
+關鍵詞匹配門檻、向量直接回答門檻、是否索引答案、索引類型及嵌入模型，
+測量 top-1/top-k 命中率、答案正確率、不需呼叫 LLM 的比例及每個問題的延遲，
+並將 Pareto 最佳的設定寫入 CustomerServiceAI 可載入的設定檔。
+
+設定檔不會被自動載入，須以 RETRIEVAL_CONFIG_FILE 環境變數或 retrieval_config 參數指定。
+selected 只會從與正式環境相同的嵌入模型及索引類型（--production-embeddings、--production-index-type）
+的結果中挑選，不會改變正式環境的嵌入模型或索引；要允許改變時加上 --allow-backend-change。
+
+使用方式:
+    python retrieval_sweep.py customer_service_qa.json
+    python retrieval_sweep.py customer_service_qa.json --paraphrases /tmp/qa_with_aliases.json --embeddings openai
+"""
+from context_builder import count_tokens
+from embedding_cache import normalize_text
+import argparse
+import itertools
+import json
+import math
+import time
+
+
+def _quiet(message):
+    pass
+
+
+def _parse_list(text, cast=str, allow_none=False):
+    values = []
+    for item in text.split(","):
+        item = item.strip()
+        if allow_none and item.lower() == "none":
+            values.append(None)
+        elif item.lower() in ("true", "false"):
+            values.append(item.lower() == "true")
+        else:
+            values.append(cast(item))
+    return values
+
+
+def percentile(values, p):
+    """最近排名法百分位數"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def build_eval_set(qa_data, paraphrases=None, stub_count=5):
+    """
+    建立評估資料
+
+    參數:
+    qa_data (list): 知識庫 Q&A 資料
+    paraphrases (list): 可選，含 aliases 的 Q&A 資料（例如 paraphrase_expansion.py 的輸出）
+    stub_count (int): 沒有任何改寫問法時，以規則式改寫產生的數量
+
+    返回:
+    tuple: (不含 aliases 的知識庫, [(查詢, 標準問題), ...], 查詢來源 "paraphrases"、"aliases" 或 "stub")
+    """
+    source = paraphrases if paraphrases is not None else qa_data
+    aliases = {qa["question"]: list(qa.get("aliases", [])) for qa in source}
+    query_source = "paraphrases" if paraphrases is not None else "aliases"
+
+    if not any(aliases.values()):
+        query_source = "stub"
+        from paraphrase_expansion import StubParaphraser
+
+        print("知識庫沒有改寫問法，改用規則式改寫產生查詢（字面與原問題相近，結果會偏樂觀）")
+        paraphraser = StubParaphraser()
+        # 第一個規則式改寫只是去掉標點的原問題，不使用
+        aliases = {qa["question"]: paraphraser.generate(qa["question"], qa["answer"], stub_count + 1)[1:]
+                   for qa in qa_data}
+
+    # 改寫問法保留作為測試資料，不放進索引
+    knowledge_base = [{key: value for key, value in qa.items() if key != "aliases"} for qa in qa_data]
+    queries = []
+    for qa in knowledge_base:
+        for alias in aliases.get(qa["question"], []):
+            if normalize_text(alias) != normalize_text(qa["question"]):
+                queries.append((alias, qa["question"]))
+    return knowledge_base, queries, query_source
+
+
+def _build_assistant(knowledge_base, embedding_backend, index_type, index_answer_docs):
+    from customer_service_ai import CustomerServiceAI
+
+    # 明確傳入空設定，避免載入 RETRIEVAL_CONFIG_FILE 指定的設定
+    cs_assistant = CustomerServiceAI(None, retrieval_config={})
+    cs_assistant.embedding_backend = embedding_backend
+    cs_assistant.index_type = index_type
+    cs_assistant.index_answer_docs = index_answer_docs
+    cs_assistant.index_aliases = False
+    cs_assistant.load_qa_data(knowledge_base)
+    if index_type != "none" and not cs_assistant.vector_index_built:
+        raise RuntimeError(cs_assistant.processing_status.get("message"))
+    return cs_assistant
+
+
+def _observe_queries(cs_assistant, queries, keyword_thresholds, max_k, embeddings):
+    """對每個查詢執行一次各階段並記錄結果與耗時，之後各參數組合直接以這些結果計算"""
+    answers = {qa["question"]: qa["answer"] for qa in cs_assistant.qa_data}
+    observations = []
+
+    for query, target in queries:
+        started = time.perf_counter()
+        exact_answer = cs_assistant._exact_match_search(query, _quiet)
+        match_time = time.perf_counter() - started
+
+        keyword_answers = {}
+        for threshold in keyword_thresholds:
+            cs_assistant.keyword_match_threshold = threshold
+            started = time.perf_counter()
+            keyword_answers[threshold] = cs_assistant._keyword_match(query, _quiet)
+            if threshold == keyword_thresholds[0]:
+                match_time += time.perf_counter() - started
+
+        observation = {
+            "target_question": target,
+            "target_answer": answers[target],
+            "exact": exact_answer,
+            "keyword": keyword_answers,
+            "match_time": match_time,
+        }
+
+        if cs_assistant.vector_index_built:
+            # 嵌入時間以未經快取的模型另外測量，搜索時間使用已快取的查詢向量
+            started = time.perf_counter()
+            embeddings.embed_query(query)
+            observation["embed_time"] = time.perf_counter() - started
+
+            cs_assistant.vector_store.similarity_search_with_score(query, max_k)
+            started = time.perf_counter()
+            docs_and_scores = cs_assistant.vector_store.similarity_search_with_score(query, max_k)
+            observation["search_time"] = time.perf_counter() - started
+            observation["docs"] = cs_assistant._collect_relevant_docs(docs_and_scores, _quiet)
+            observation["rank"] = next(
+                (i for i, (doc, _) in enumerate(observation["docs"]) if doc.metadata.get("question") == target),
+                None,
+            )
+
+        observations.append(observation)
+    return observations
+
+
+def evaluate(cs_assistant, observations, params, llm_latency):
+    """依記錄的結果模擬 answer_question 的流程，計算一組參數的指標"""
+    from context_builder import build_context
+
+    k = params["search_k"]
+    top1 = topk = correct = skipped = 0
+    latencies = []
+    expected_latencies = []
+    context_tokens = []
+
+    for obs in observations:
+        rank = obs.get("rank")
+        top1 += rank == 0
+        topk += rank is not None and rank < k
+
+        latency = obs["match_time"]
+        answer = None
+        if obs["exact"]:
+            answer, is_correct = obs["exact"], obs["exact"] == obs["target_answer"]
+        elif obs["keyword"][params["keyword_match_threshold"]] and not cs_assistant.vector_index_built:
+            keyword_answer = obs["keyword"][params["keyword_match_threshold"]]
+            answer, is_correct = keyword_answer, keyword_answer == obs["target_answer"]
+        elif cs_assistant.vector_index_built and obs["docs"]:
+            latency += obs["embed_time"] + obs["search_time"]
+            docs = obs["docs"][:k]
+            threshold = params["vector_direct_answer_threshold"]
+            if threshold is not None and docs[0][1] <= threshold:
+                answer = docs[0][0].metadata.get("answer")
+                is_correct = answer == obs["target_answer"]
+            else:
+                # LLM 生成的答案以標準問答對是否在上下文中作為正確性的近似（答案可能被截斷，以問題判斷）
+                context = build_context(docs, max_tokens=cs_assistant.context_token_budget,
+                                        max_pairs=params["context_top_n"],
+                                        max_answer_tokens=cs_assistant.context_answer_token_limit)
+                context_tokens.append(count_tokens(context))
+                is_correct = f"問題: {obs['target_question']}\n" in context
+        else:
+            is_correct = False
+
+        skipped += answer is not None
+        correct += is_correct
+        latencies.append(latency)
+        expected_latencies.append(latency + (0 if answer is not None else llm_latency))
+
+    total = len(observations) or 1
+    return {
+        "top1_accuracy": round(top1 / total, 4),
+        "topk_accuracy": round(topk / total, 4),
+        "answer_accuracy": round(correct / total, 4),
+        "llm_skip_rate": round(skipped / total, 4),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "expected_latency_ms": round(sum(expected_latencies) / total * 1000, 2),
+        "mean_context_tokens": round(sum(context_tokens) / len(context_tokens), 1) if context_tokens else 0,
+    }
+
+
+# Pareto 比較的指標：(名稱, 越大越好)
+OBJECTIVES = [
+    ("answer_accuracy", True),
+    ("llm_skip_rate", True),
+    ("expected_latency_ms", False),
+    ("mean_context_tokens", False),
+]
+
+
+def _objective_values(metrics):
+    return tuple(metrics[name] if maximize else -metrics[name] for name, maximize in OBJECTIVES)
+
+
+def _dominates(a, b):
+    values_a, values_b = _objective_values(a), _objective_values(b)
+    return all(x >= y for x, y in zip(values_a, values_b)) and values_a != values_b
+
+
+def pareto_front(results):
+    """
+    答案正確率、LLM 略過率（越高越好）與預期延遲、上下文 token 數（越低越好）的 Pareto 最佳結果
+
+    指標完全相同的組合只保留第一個（掃描順序中 k 與上下文較小者），依正確率由高到低排序。
+    """
+    front = []
+    seen = set()
+    for result in results:
+        values = _objective_values(result["metrics"])
+        if values in seen or any(_dominates(other["metrics"], result["metrics"]) for other in results):
+            continue
+        seen.add(values)
+        front.append(result)
+    return sorted(front, key=lambda r: tuple(-v for v in _objective_values(r["metrics"])))
+
+
+def select_config(front, results, embedding_backend, index_type, allow_backend_change=False):
+    """
+    挑選寫入 selected 的設定
+
+    預設只考慮與正式環境相同嵌入模型及索引類型的結果，避免離線評估改變正式環境的檢索方式；
+    這些結果中優先使用 Pareto 最佳者，其次為正確率最高者。
+
+    返回:
+    dict or None: 設定參數，沒有符合的結果時返回 None
+    """
+    if allow_backend_change:
+        return front[0]["params"]
+
+    def matches(result):
+        return (result["params"]["embedding_backend"] == embedding_backend
+                and result["params"]["index_type"] == index_type)
+
+    candidates = [r for r in front if matches(r)] or pareto_front([r for r in results if matches(r)])
+    return candidates[0]["params"] if candidates else None
+
+
+def run_sweep(knowledge_base, queries, grid, llm_latency=1.5):
+    """
+    掃描參數組合
+
+    參數:
+    knowledge_base (list): 不含 aliases 的 Q&A 資料
+    queries (list): [(查詢, 標準問題), ...]
+    grid (dict): 各參數的候選值
+    llm_latency (float): 估計每次呼叫 LLM 的秒數，用於計算預期延遲
+
+    返回:
+    list: 每個組合的 {"params": ..., "metrics": ...}
+    """
+    results = []
+    max_k = max(grid["search_k"])
+    index_options = itertools.product(grid["embedding_backend"], grid["index_type"], grid["index_answer_docs"])
+
+    for embedding_backend, index_type, index_answer_docs in index_options:
+        if index_type == "none" and (embedding_backend, index_answer_docs) != (grid["embedding_backend"][0],
+                                                                               grid["index_answer_docs"][0]):
+            # 不建立向量索引時嵌入模型與索引內容沒有影響
+            continue
+
+        print(f"建立索引: embedding_backend={embedding_backend}, index_type={index_type}, "
+              f"index_answer_docs={index_answer_docs}")
+        started = time.perf_counter()
+        try:
+            cs_assistant = _build_assistant(knowledge_base, embedding_backend, index_type, index_answer_docs)
+        except Exception as e:
+            print(f"略過此索引設定: {str(e)}")
+            continue
+        build_time = time.perf_counter() - started
+
+        embeddings = cs_assistant._create_embeddings() if cs_assistant.vector_index_built else None
+        observations = _observe_queries(cs_assistant, queries, grid["keyword_match_threshold"], max_k, embeddings)
+
+        if cs_assistant.vector_index_built:
+            search_options = [
+                (k, top_n, threshold)
+                for k, top_n, threshold in itertools.product(
+                    grid["search_k"], grid["context_top_n"], grid["vector_direct_answer_threshold"])
+                # 上下文問答對數量超過搜索數量時與較小的設定相同
+                if top_n <= k
+            ]
+        else:
+            search_options = [(grid["search_k"][0], grid["context_top_n"][0], None)]
+
+        for keyword_threshold in grid["keyword_match_threshold"]:
+            for k, top_n, threshold in search_options:
+                params = {
+                    "embedding_backend": embedding_backend,
+                    "index_type": index_type,
+                    "index_answer_docs": index_answer_docs,
+                    "index_aliases": True,
+                    "search_k": k,
+                    "context_top_n": top_n,
+                    "keyword_match_threshold": keyword_threshold,
+                    "vector_direct_answer_threshold": threshold,
+                }
+                metrics = evaluate(cs_assistant, observations, params, llm_latency)
+                metrics["index_build_s"] = round(build_time, 2)
+                results.append({"params": params, "metrics": metrics})
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="檢索參數離線評估")
+    parser.add_argument("qa_file", nargs="?", default="customer_service_qa.json", help="知識庫 JSON 檔案")
+    parser.add_argument("--paraphrases", help="含 aliases 的 Q&A 檔案，作為保留的測試問法")
+    parser.add_argument("--stub-count", type=int, default=5, help="沒有改寫問法時每題以規則產生的數量")
+    parser.add_argument("--embeddings", default="local", help="嵌入模型，以逗號分隔（local、openai、openai:<模型>）")
+    parser.add_argument("--index-types", default="flat,hnsw,none", help="索引類型，以逗號分隔")
+    parser.add_argument("--index-answer-docs", default="true,false", help="是否索引答案，以逗號分隔")
+    parser.add_argument("--k", default="1,3,5,10", help="search_k 候選值")
+    parser.add_argument("--top-n", default="1,2,3,5", help="context_top_n 候選值")
+    parser.add_argument("--keyword-thresholds", default="1,2,3", help="keyword_match_threshold 候選值")
+    parser.add_argument("--direct-thresholds", default="none,0.2,0.4,0.6,0.8",
+                        help="vector_direct_answer_threshold 候選值（none 表示一律呼叫 LLM）")
+    parser.add_argument("--llm-latency", type=float, default=1.5, help="估計每次呼叫 LLM 的秒數")
+    parser.add_argument("--production-embeddings", default="openai", help="正式環境使用的嵌入模型")
+    parser.add_argument("--production-index-type", default="flat", help="正式環境使用的索引類型")
+    parser.add_argument("--allow-backend-change", action="store_true",
+                        help="允許 selected 使用與正式環境不同的嵌入模型或索引類型")
+    parser.add_argument("--output", default="retrieval_sweep_config.json",
+                        help="輸出設定檔（不會被自動載入，須以 RETRIEVAL_CONFIG_FILE 指定）")
+    parser.add_argument("--all-results", help="另外輸出所有組合的結果")
+    args = parser.parse_args()
+
+    with open(args.qa_file, "r", encoding="utf-8") as f:
+        qa_data = json.load(f)
+    paraphrases = None
+    if args.paraphrases:
+        with open(args.paraphrases, "r", encoding="utf-8") as f:
+            paraphrases = json.load(f)
+
+    if any(backend.startswith("openai") for backend in args.embeddings.split(",")):
+        from dotenv import load_dotenv
+        load_dotenv()
+
+    knowledge_base, queries, query_source = build_eval_set(qa_data, paraphrases, args.stub_count)
+    print(f"知識庫 {len(knowledge_base)} 個問答對，測試問法 {len(queries)} 個")
+    if not queries:
+        print("沒有可用的測試問法")
+        return
+
+    grid = {
+        "embedding_backend": _parse_list(args.embeddings),
+        "index_type": _parse_list(args.index_types),
+        "index_answer_docs": _parse_list(args.index_answer_docs),
+        "search_k": _parse_list(args.k, int),
+        "context_top_n": _parse_list(args.top_n, int),
+        "keyword_match_threshold": _parse_list(args.keyword_thresholds, int),
+        "vector_direct_answer_threshold": _parse_list(args.direct_thresholds, float, allow_none=True),
+    }
+    results = run_sweep(knowledge_base, queries, grid, args.llm_latency)
+    if not results:
+        print("沒有成功評估的設定")
+        return
+
+    front = pareto_front(results)
+    print(f"\n評估 {len(results)} 組設定，Pareto 最佳 {len(front)} 組:")
+    for result in front:
+        m = result["metrics"]
+        print(f"  正確率 {m['answer_accuracy']:.3f}  top-1 {m['top1_accuracy']:.3f}  top-k {m['topk_accuracy']:.3f}  "
+              f"略過 LLM {m['llm_skip_rate']:.3f}  預期延遲 {m['expected_latency_ms']:.1f} ms  "
+              f"{result['params']}")
+
+    selected = select_config(front, results, args.production_embeddings, args.production_index_type,
+                             args.allow_backend_change)
+    config = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "qa_file": args.qa_file,
+        "queries": len(queries),
+        "query_source": query_source,
+        "llm_latency_s": args.llm_latency,
+        # CustomerServiceAI.load_retrieval_config 使用 selected 中的參數
+        "selected": selected,
+        "pareto": front,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+
+    print(f"已寫入 {args.output}（須以 RETRIEVAL_CONFIG_FILE 指定才會被載入）")
+    if selected is None:
+        print(f"沒有使用正式環境設定（embedding_backend={args.production_embeddings}, "
+              f"index_type={args.production_index_type}）的結果，selected 留空；"
+              f"請加入該嵌入模型重新評估，或使用 --allow-backend-change")
+    else:
+        print(f"selected: {selected}")
+    if query_source == "stub":
+        print("注意: 測試問法為規則式改寫，結果偏樂觀，正式使用前請以 --paraphrases 提供真實改寫問法重新評估")
+
+    if args.all_results:
+        with open(args.all_results, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    main()